@@ -51,37 +51,84 @@ References:
 * McWilliams Initial Condition inspired by pyqg [https://github.com/pyqg/pyqg]
 """
 
+from collections import OrderedDict
+
 import numpy as np
 
 from numpy import pi, cos, sin
 from numpy.fft import fftshift, fftfreq
-from numpy.fft.fftpack import rfft2, irfft2
-
-# # if available, we will use pyFFTW for performing Fourier Transforms
-# try:
-#     import pyfftw
-#     from pyfftw.interfaces.numpy_fft import fftshift, fftn, ifftn
-#     pyfftw.interfaces.cache.enable()
-#     PYFFTW = True
-# except:
-#     print("WARNING: pyfftw not available.  Falling back to numpy")
-#     from numpy.fft import fftshift, fftfreq
-#     from numpy.fft.fftpack import rfft2, irfft2
-#     PYFFTW = False
+
+from transforms import make_transform
 
 def ft(phi):
     """Go from physical space to spectral space."""
-    return rfft2(phi, axes=(-2, -1))
+    return np.fft.rfft2(phi, axes=(-2, -1))
 
 def ift(psi):
     """Go from spectral space to physical space."""
-    return irfft2(psi, axes=(-2,-1))
+    return np.fft.irfft2(psi, axes=(-2,-1))
 
 
 class BarotropicVorticity(object):
-    """A square domain barotropic vorticity model."""
+    """A doubly periodic barotropic vorticity model.
+
+    The domain is square, n points of L in each direction, unless `nx`, `ny`,
+    `Lx` or `Ly` are given.  Physical fields have shape (ny, nx), with y
+    along the first axis; nx and ny must be even.
+
+    With `n_members` the model is an ensemble: the fields have a leading
+    member axis, (n_members, ny, nx) and (n_members, nl, nk), and all the
+    members are stepped together with batched transforms.  Ensemble
+    statistics are reductions over the first axis, e.g. `bv.z.std(axis=0)`.
+    The members share the smallest timestep the controller chooses for
+    them, or each has its own when `member_dt` is True, when `dt` and `t`
+    are arrays over the members.  Each member then follows the run of a
+    single member to round-off: the Adams-Bashforth weights are evaluated
+    as arrays over the members.
+
+    `dealias` chooses how the Jacobian is dealiased:
+
+        '2/3'   truncate the spectrum of the state at 2/3 of the maximum
+                wavenumber (the circle through the corners of the 2/3 square)
+        '3/2'   evaluate the Jacobian on a grid padded by 3/2, rounded up
+                to an even size, which keeps all but the Nyquist wavenumbers
+
+    `timestepper` chooses the time integration:
+
+        'ab3'     Adams-Bashforth 3 of the whole rhs, with the high
+                  wavenumber filter in place of the hyperviscosity
+        'ifab3'   integrating factor Adams-Bashforth 3
+        'etdrk4'  exponential time differencing RK4 (Cox & Matthews 2002)
+
+    The last two integrate the linear terms exactly, that is hyperviscosity,
+    Rayleigh drag, the beta term and advection by ubar, and step the
+    Jacobian and forcing explicitly.  Their timestep is limited only by the
+    advective CFL.
+
+    The timestep is chosen at each step by a PI controller that steers the
+    Courant number towards `cfl`
+
+        dt' = dt (cfl/c)^k_i (c_prev/c)^k_p
+
+    growing by at most `dt_growth` per step and bounded by `dt_min` and
+    `dt_max`.  The Adams-Bashforth weights allow for the changing step.
+    For the exponential timesteppers dt is rounded down to one of
+    `dt_levels` values per factor of 2, so their coefficients can be reused.
+    """
     _prhs = 0.0
     _pprhs = 0.0
+    timesteppers = ('ab3', 'ifab3', 'etdrk4')
+    coefficient_cache_size = 8     # dt values kept in the coefficient cache
+    contour_points = 32            # points of the contour integrals of ETDRK4
+
+    cfl = 0.4           # target Courant number of the dt controller
+    cfl_max = 0.8       # the step is cut back at once above this
+    k_i = 0.3           # integral and proportional gains of the controller
+    k_p = 0.2
+    dt_growth = 1.2
+    dt_min = 0.0
+    dt_max = np.inf
+    dt_levels = 16
 
     def __init__(self,
         n,              # numerical resolution
@@ -89,38 +136,70 @@ class BarotropicVorticity(object):
         ubar=0.0,       # background velocity [m/s]
         beta=0.0,       # beta plane value: f = f0 + βy  [m^-1.s^-1]
         tau=0.1,        # coeff of dissipation. smaller = more diss.
-        n_diss = 2.0    # Small-scale dissipation of the form ∆^2n_diss,
+        n_diss = 2.0,   # Small-scale dissipation of the form ∆^2n_diss,
                         # such that n_diss = 2 would be a ∆^4 hyperviscosity.
+        r=0.0,          # Rayleigh drag [s^-1]
+        fft='numpy',    # FFT backend: 'pyfftw', 'scipy' or 'numpy'
+        fft_workers=1,  # threads used by the pyfftw and scipy backends
+        timestepper='ab3',  # 'ab3', 'ifab3' or 'etdrk4', see above
+        dealias='2/3',  # '2/3' or '3/2', see above
+        nx=None,        # x and y resolution, default n
+        ny=None,
+        Lx=None,        # x and y domain size [m], default L
+        Ly=None,
+        n_members=None, # number of ensemble members, see above
+        member_dt=False # a timestep for each member
         ):
 
+        if dealias not in ('2/3', '3/2'):
+            raise ValueError("Unknown dealias '%s', use '2/3' or '3/2'" % dealias)
+        self.dealias = dealias
+
+        if timestepper not in self.timesteppers:
+            raise ValueError("Unknown timestepper '%s', use one of %s" % (timestepper, ', '.join(self.timesteppers)))
+        self.timestepper = timestepper
+
+        # the transforms are done by a per-model backend, see transforms.py
+        self.transform = make_transform(fft, fft_workers)
+        self.ft = self.transform.ft
+        self.ift = self.transform.ift
+
         self.ubar = ubar
         self.beta = beta
+        self.r = r
 
         # Physical Domain (real):
-        # for simplicity, use a square domain
-        self.Lx = self.Ly = L
-        self.nx = self.ny = n
-        self.dx = dx = L / n
-        self.dy = dy = L / n
-        self.y = np.linspace(0, L, n)
-        self.x = np.linspace(0, L, n)
-        self.dt = 0.4 * 16.0 / n    # choose an initial dt. This will change
+        # square unless the x and y sizes are given
+        self.Lx = Lx = L if Lx is None else Lx
+        self.Ly = Ly = L if Ly is None else Ly
+        self.nx = nx = n if nx is None else nx
+        self.ny = ny = n if ny is None else ny
+        if nx % 2 or ny % 2:
+            raise ValueError('nx and ny must be even')
+        self.dx = dx = Lx / nx
+        self.dy = dy = Ly / ny
+        self.y = np.linspace(0, Ly, ny)
+        self.x = np.linspace(0, Lx, nx)
+        self.dt = 0.4 * 16.0 * min(dx, dy)  # choose an initial dt. This will change
                                     # as the simulation progresses to maintain
                                     # numerical stability
+        self.n_members = n_members
+        self.member_dt = bool(n_members and member_dt)
+        members = (n_members,) if n_members else ()
 
         # Spectral Domain (complex):
-        self.nl = n
-        self.nk = n//2 + 1
-        self.dk = 2.0*pi/L
-        self.dl = 2.0*pi/L
+        self.nl = ny
+        self.nk = nx//2 + 1
+        self.dk = 2.0*pi/Lx
+        self.dl = 2.0*pi/Ly
         # calculate the wavenumbers [1/m]
         # The real FT has half the number of wavenumbers in one direction:
         # FT_x[real] -> complex : 1/2 as many complex numbers needed as real signal
         # FT_y[complex] -> complex : After the first transform has been done the signal
         # is complex, therefore the transformed domain in second dimension is same size
         # as it is in euclidean space.
-        # Therefore FT[(nx, ny)] -> (nx/2, ny)
-        # The 2D Inverse transform returns a real-only domain (nx, ny)
+        # Therefore FT[(ny, nx)] -> (ny, nx/2+1)
+        # The 2D Inverse transform returns a real-only domain (ny, nx)
         self.k = k = self.dk*np.arange(0, self.nk, dtype=np.float64)[np.newaxis, :]
         self.l = l = self.dl*fftfreq(self.nl, d=1.0/self.nl)[:, np.newaxis]
 
@@ -136,28 +215,98 @@ class BarotropicVorticity(object):
         # Dissipation & Spectral Filters:
         # Use ∆^2n_diss hyperviscosity to diffuse at small scales (i.e. n_diss = 2 would be ∆^4)
         # use the x-dimension for reference scale values
-        self.nu = ((L/(np.floor(n/3)*2.0*pi))**(2*n_diss))/tau
+        self.nu = ((Lx/(np.floor(nx/3)*2.0*pi))**(2*n_diss))/tau
         self.n_diss = n_diss
 
+        # the linear operator of the exponential integrators, by wavenumber:
+        # ∂/∂t[F[ζ]] = (- ik ubar + ik β/(k^2 + l^2) - ν (k^2 + l^2)^n_diss - r) F[ζ]
+        ksq0 = k**2 + l**2                   # without the zero wavenumber fix
+        self.linear = -self.ik*ubar + self.ik*beta*self.rksq - self.nu*ksq0**n_diss - r
+        # coefficients of the exponential integrators for recent timesteps
+        self._coefficient_cache = OrderedDict()
+
+        # the spectral filters, as arrays to multiply the spectrum by.
+        # They are functions of kappa, the wavenumber as a fraction of the
+        # largest, max|k| and max|l|, in each direction, so elliptical in
+        # wavenumber when the x and y resolutions differ.  Their sizes are
+        # those of the square model of min(nx, ny) points, m wavenumbers to
+        # the largest, so a domain tiled by squares is filtered as the square is
+        m = min(nx, ny)//2
+        kappa = np.sqrt((k/(self.dk*(nx//2)))**2 + (l/(self.dl*(ny//2)))**2)
+        if dealias == '2/3':
+            k_mask = (8./9.)*((m + 2.0)/m)**2.
+            self._dealias_filter = np.where(kappa**2 >= k_mask, 0.0, 1.0)
+        else:
+            # the 3/2 padded grid, only the Nyquist wavenumbers are removed.
+            # The padded sizes are rounded up to even, as the inverse
+            # transforms return an even number of points in x
+            self.nx_padded = 2*((3*nx + 3)//4)
+            self.ny_padded = 2*((3*ny + 3)//4)
+            self._dealias_filter = np.ones_like(kappa)
+            self._dealias_filter[ny//2, :] = 0.0
+            self._dealias_filter[:, -1] = 0.0
+        # the high wavenumber filter of Smith et al. (2002), from wavenumber
+        # index 30 of m
+        filter_exp = 8.0
+        kcut = 30.0/m
+        kend = (m + 1.0)/m
+        filter_dec = -np.log(1.+2.*pi/(m + 1))/((kend-kcut)**filter_exp)
+        self._high_wn_filter = np.ones_like(kappa)
+        filter_idx = kappa >= kcut
+        self._high_wn_filter[filter_idx] = np.exp(filter_dec*(kappa[filter_idx]-kcut)**filter_exp)
+
         self.t = 0.0                # time
+        if self.member_dt:
+            self.t = np.zeros(n_members)
+            self.dt = np.full(n_members, self.dt)
         self.tc = 0                 # step count
+        self._dts = []              # the previous two timesteps
+        self._courant = None        # the Courant number of the previous step
+
+        # a stochastic forcing of zt, drawn once per step, see forcing.py
+        self.stochastic_forcing = None
 
         # physical and transformed variables
-        self._z = np.zeros((self.nx,self.ny), dtype=np.float64)
-        self._zt = np.zeros((self.nl,self.nk), dtype=np.complex128)
+        self._z = np.zeros(members + (self.ny,self.nx), dtype=np.float64)
+        self._zt = np.zeros(members + (self.nl,self.nk), dtype=np.complex128)
 
-        self.psi = np.zeros_like(self._z)
+        self._psi = np.zeros_like(self._z)
         self.psit = np.zeros_like(self._zt)
 
+        # fields derived from the state, calculated once per step when first
+        # needed: 'z', 'psi' and 'velocity'.  Emptied when the state changes.
+        self._cache = {}
+
+
+    @property
+    def fft_backend(self):
+        """The name of the FFT backend in use."""
+        return self.transform.backend
 
     def courant_number(self):
         """Calculate the Courant Number given the velocity field and step size."""
         u,v = self.velocity()
-        maxu = np.max(np.abs(u))
-        maxv = np.max(np.abs(v))
-        maxvel = maxu + maxv
+        maxu = np.max(np.abs(u), axis=(-2, -1))    # of each member
+        maxv = np.max(np.abs(v), axis=(-2, -1))
+        maxvel = maxu + maxv*self.dx/self.dy    # in units of dx
         return maxvel*self.dt/self.dx
 
+    def _spectral_mean(self, phit, weight):
+        """The domain mean of `weight` |φ|^2, summed over the rfft spectrum
+        `phit`, for each member."""
+        # the coefficients with 0 < k < nx/2 stand for a pair of conjugates
+        pairs = np.full(self.nk, 2.0)
+        pairs[0] = pairs[-1] = 1.0
+        return np.sum(pairs * weight * np.abs(phit)**2, axis=(-2, -1)) / (self.nx*self.ny)**2
+
+    def energy(self):
+        """The mean kinetic energy 1/2 |u|^2 of each member."""
+        return 0.5 * self._spectral_mean(self.psit, self.k**2 + self.l**2)
+
+    def enstrophy(self):
+        """The mean enstrophy 1/2 ζ^2 of each member."""
+        return 0.5 * self._spectral_mean(self.zt, 1.0)
+
     def grad(self, phit):
         """Returns the spatial derivatives of a Fourier transformed variable.
         Returns (∂/∂x[F[φ]], ∂/∂y[F[φ]]) i.e. (ik F[φ], il F[φ])"""
@@ -167,23 +316,40 @@ class BarotropicVorticity(object):
 
     def velocity(self):
         """Returns the velocity field (u, v) from F[ψ]."""
-        psixt, psiyt = self.grad(self.psit)
-        psix = ift(psixt)    # v =   ∂/∂x[ψ]
-        psiy = ift(psiyt)    # u = - ∂/∂y[ψ]
-        return (-psiy, psix)
+        if 'velocity' not in self._cache:
+            psix, psiy = self.ift(np.stack(self.grad(self.psit)))
+            self._cache['velocity'] = (-psiy, psix)     # u = - ∂/∂y[ψ], v = ∂/∂x[ψ]
+        return self._cache['velocity']
 
     def anti_alias(self, phit):
-        """Set the coefficients of wavenumbers > k_mask to be zero."""
-        k_mask = (8./9.)*(self.nk+1)**2.
-        phit[(np.abs(self.ksq/(self.dk*self.dk)) >= k_mask)] = 0.0
+        """Set the coefficients of the wavenumbers removed by the dealiasing to be zero."""
+        phit *= self._dealias_filter
 
     def high_wn_filter(self, phit):
         """Applies the high wavenumber filter of smith et al 2002"""
-        filter_exp = 8.0
-        kcut = 30.0
-        filter_dec = -np.log(1.+2.*pi/self.nk)/((self.nk-kcut)**filter_exp)
-        filter_idx = np.abs(self.ksq/(self.dk*self.dk)) >= kcut**2.
-        phit[filter_idx] *= np.exp(filter_dec*(np.sqrt(self.ksq[filter_idx]/(self.dk*self.dk))-kcut)**filter_exp)
+        phit *= self._high_wn_filter
+
+    def _pad(self, phit):
+        """Zero pad spectra on the (n, n) grid to the 3/2 padded grid,
+        scaled so that the inverse transform gives the same field values."""
+        nx, ny, mx, my = self.nx, self.ny, self.nx_padded, self.ny_padded
+        hx, hy = nx//2, ny//2
+        padded = np.zeros(phit.shape[:-2] + (my, mx//2 + 1), dtype=np.complex128)
+        padded[..., :hy, :hx] = phit[..., :hy, :hx]
+        padded[..., my-hy+1:, :hx] = phit[..., hy+1:, :hx]
+        padded *= (mx*my)/(nx*ny)
+        return padded
+
+    def _truncate(self, phit):
+        """The spectrum of a field on the 3/2 padded grid, truncated to the
+        (n, n) grid; the inverse of `_pad`."""
+        nx, ny, mx, my = self.nx, self.ny, self.nx_padded, self.ny_padded
+        hx, hy = nx//2, ny//2
+        truncated = np.zeros(phit.shape[:-2] + (ny, self.nk), dtype=np.complex128)
+        truncated[..., :hy, :hx] = phit[..., :hy, :hx]
+        truncated[..., hy+1:, :hx] = phit[..., my-hy+1:, :hx]
+        truncated *= (nx*ny)/(mx*my)
+        return truncated
 
     @property
     def zt(self):
@@ -193,98 +359,237 @@ class BarotropicVorticity(object):
     def zt(self, value):
         # set the transformed value of zeta
         self._zt[:] = value
-        # update physical zeta and other dependents
-        self._z[:] = ift(value)
+        # update the dependents, physical zeta is transformed when next used
         self._update_psi()
 
     @property
     def z(self):
+        if 'z' not in self._cache:
+            self._cache['z'] = self.ift(self._zt, out=self._z)
         return self._z
 
     @z.setter
     def z(self, value):
         self._z[:] = value
-        self._zt[:] = ft(value)
+        self.ft(value, out=self._zt)
         self._update_psi()
+        self._cache['z'] = self._z
+
+    @property
+    def psi(self):
+        if 'psi' not in self._cache:
+            self._cache['psi'] = self.ift(self.psit, out=self._psi)
+        return self._psi
 
     def _update_psi(self):
         """After z or zt have changed, update the streamfunction."""
+        self._cache = {}
         self.psit[:] = -self.rksq * self._zt     # F[ψ] = - F[ζ] / (k^2 + l^2)
-        self.psi[:] = ift(self.psit)
 
 
     def step(self):
-        """Take a single step forward in time using Adams-Bashforth 3."""
-        dt = self.dt
-
+        """Take a single step forward in time with the model's timestepper.
+        A step takes five transforms for each evaluation of the rhs: the
+        batched inverse transform of the gradients and the transform of the
+        Jacobian.  The timestep is chosen first, from the Courant number of
+        the current state, so that the stochastic forcing of the step is
+        drawn for it; the first rhs reuses the velocity of the Courant number
+        check, except with the '3/2' dealiasing when the rhs is calculated
+        on the padded grid."""
         # calculate the size of timestep that can be taken
-        c = self.courant_number()
-        if c >= 0.8:
-            print('DEBUG: Courant No > 0.8, reducing timestep')
-            dt = 0.9*dt
-        elif c < 0.4:
-            dt = 1.1*dt
-
-        if self.tc is 0:
-            # forward euler
-            dt1 = dt
-            dt2 = 0.0
-            dt3 = 0.0
-        elif self.tc is 1:
-            # AB2 at step 2
-            dt1 = 1.5*dt
-            dt2 = -0.5*dt
-            dt3 = 0.0
+        dt = self._control_dt(self.courant_number())
+        mdt = self._member(dt)
+        if self.stochastic_forcing is not None:
+            self.stochastic_forcing.advance(mdt)
+
+        if self.timestepper == 'ab3':
+            rhs = self.rhs()
         else:
-            # AB3 from step 3 on
-            dt1 = 23./12.*dt
-            dt2 = -16./12.*dt
-            dt3 = 5./12.*dt
-
-        rhs = self.rhs()
-        newzt = self.zt + dt1*rhs + dt2*self._prhs + dt3*self._pprhs
-        self._pprhs = self._prhs
-        self._prhs  = rhs
-
-        # apply hyperviscosity
-        #deln = 1.0 / (1.0 + self.nu*self.ksq**self.n_diss*dt)
-        #newzt = newzt*deln
-        self.high_wn_filter(newzt)
+            rhs = self.nonlinear()
+
+        if self.timestepper == 'etdrk4':
+            newzt = self._etdrk4(mdt, rhs)
+        else:
+            dt1, dt2, dt3 = self._ab3_coefficients(mdt)
+            if self.timestepper == 'ifab3':
+                # the earlier nonlinear terms are kept propagated to the
+                # current time by the integrating factor
+                E, = self._coefficients(mdt)
+                newzt = E*(self.zt + dt1*rhs + dt2*self._prhs + dt3*self._pprhs)
+                self._pprhs = E*self._prhs
+                self._prhs  = E*rhs
+            else:
+                newzt = self.zt + dt1*rhs + dt2*self._prhs + dt3*self._pprhs
+                self._pprhs = self._prhs
+                self._prhs  = rhs
+
+                # apply hyperviscosity
+                #deln = 1.0 / (1.0 + self.nu*self.ksq**self.n_diss*dt)
+                #newzt = newzt*deln
+                self.high_wn_filter(newzt)
         self.anti_alias(newzt)
 
         # update the state
         self.zt = newzt
         self.tc = self.tc + 1
         self.t = self.t + dt
+        self.dt = dt
+        self._dts = [mdt] + self._dts[:1]
+
+    def _member(self, value):
+        """A value for each member, shaped to broadcast against the fields."""
+        if np.ndim(value):
+            return np.reshape(value, (-1, 1, 1))
+        return value
+
+    def _control_dt(self, c):
+        """The timestep for a Courant number `c` with the current dt.
+        For an ensemble, `c` has a value for each member."""
+        c = np.asarray(c, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(c > 0, (self.cfl / c)**self.k_i, self.dt_growth)
+            if self._courant is not None:
+                prev = self._courant
+                factor = factor * np.where((c > 0) & (prev > 0), (prev / c)**self.k_p, 1.0)
+            factor = np.minimum(factor, self.dt_growth)
+            cut = c >= self.cfl_max
+            if np.any(cut):
+                print('DEBUG: Courant No > %.2f, reducing timestep' % self.cfl_max)
+                factor = np.where(cut, 0.9 * self.cfl / c, factor)
+        self._courant = c
+        dt = np.clip(factor*self.dt, self.dt_min, self.dt_max)
+
+        if self.timestepper != 'ab3':
+            levels = self.dt_levels
+            dt = 2.0**(np.floor(levels*np.log2(dt) + 1e-9) / levels)
+        if not self.member_dt:
+            # the members share the most conservative timestep
+            dt = float(np.min(dt))
+        return dt
+
+    def _ab3_coefficients(self, dt):
+        """The Adams-Bashforth weights of the current and previous two rhs,
+        for a timestep that may change between steps."""
+        if len(self._dts) == 0:
+            # forward euler
+            dt1 = dt
+            dt2 = 0.0
+            dt3 = 0.0
+        elif len(self._dts) == 1:
+            # AB2 at step 2
+            r = 0.5 * dt / self._dts[0]
+            dt1 = (1 + r)*dt
+            dt2 = -r*dt
+            dt3 = 0.0
+        else:
+            a, b = self._dts
+            if np.all(dt == a) and np.all(a == b):
+                # AB3 from step 3 on
+                dt1 = 23./12.*dt
+                dt2 = -16./12.*dt
+                dt3 = 5./12.*dt
+            else:
+                # integrate the quadratic through the last three rhs
+                # at t, t-a and t-a-b from t to t+dt
+                dt1 = (dt**3/3 + (2*a + b)*dt**2/2 + a*(a + b)*dt) / (a*(a + b))
+                dt2 = -(dt**3/3 + (a + b)*dt**2/2) / (a*b)
+                dt3 = (dt**3/3 + a*dt**2/2) / (b*(a + b))
+        return dt1, dt2, dt3
+
+    def _etdrk4(self, dt, nu):
+        """The ETDRK4 update of zt, given its nonlinear terms `nu`."""
+        E, E2, Q, f1, f2, f3 = self._coefficients(dt)
+        zt = self.zt
+        a = E2*zt + Q*nu
+        na = self.nonlinear(a)
+        b = E2*zt + Q*na
+        nb = self.nonlinear(b)
+        c = E2*a + Q*(2.0*nb - nu)
+        nc = self.nonlinear(c)
+        return E*zt + f1*nu + 2.0*f2*(na + nb) + f3*nc
+
+    def _coefficients(self, dt):
+        """The coefficient arrays of the exponential timestepper for a step `dt`.
+        They are kept in an LRU cache keyed on dt, as the adaptive timestep
+        often returns to a recent value."""
+        if np.ndim(dt):
+            # a timestep for each member: gather the coefficients of each value
+            values, member = np.unique(dt, return_inverse=True)
+            coeffs = [self._coefficients(float(value)) for value in values]
+            return tuple(np.stack(c)[member.ravel()] for c in zip(*coeffs))
+
+        cache = self._coefficient_cache
+        if dt in cache:
+            cache.move_to_end(dt)
+            return cache[dt]
+
+        Ldt = self.linear*dt
+        if self.timestepper == 'ifab3':
+            coeffs = (np.exp(Ldt),)
+        else:
+            # the phi-functions by the contour integrals of Kassam & Trefethen
+            # (2005), which avoid the cancellation errors near Ldt = 0
+            M = self.contour_points
+            Q = np.zeros_like(Ldt)
+            f1 = np.zeros_like(Ldt)
+            f2 = np.zeros_like(Ldt)
+            f3 = np.zeros_like(Ldt)
+            for root in np.exp(2j*pi*(np.arange(M) + 0.5)/M):
+                LR = Ldt + root
+                eLR = np.exp(LR)
+                Q += (np.exp(LR/2) - 1.0) / LR
+                f1 += (-4.0 - LR + eLR*(4.0 - 3.0*LR + LR**2)) / LR**3
+                f2 += (2.0 + LR + eLR*(LR - 2.0)) / LR**3
+                f3 += (-4.0 - 3.0*LR - LR**2 + eLR*(4.0 - LR)) / LR**3
+            coeffs = (np.exp(Ldt), np.exp(Ldt/2), dt*Q/M, dt*f1/M, dt*f2/M, dt*f3/M)
+
+        cache[dt] = coeffs
+        if len(cache) > self.coefficient_cache_size:
+            cache.popitem(last=False)
+        return coeffs
 
     def forcing(self):
         """Apply a forcing in physical space."""
         return None
 
     def forcingt(self):
-        """Apply a forcing in spectral space."""
-        amp = 0.01
-        forcet = np.zeros_like(self.zt)
-        K = np.sqrt(self.ksq)/self.dk
-        idx = (14 < K) & (K < 20)
-        forcet[idx] = amp*0.5*(np.random.random(forcet.shape)[idx] - 0.5)*np.exp(1j*2.*pi*np.random.random(forcet.shape)[idx])
+        """Apply a forcing in spectral space.  By default the
+        `stochastic_forcing` of the model, if there is one."""
+        if self.stochastic_forcing is not None:
+            return self.stochastic_forcing.forcet
         return 0.0
 
-    def rhs(self):
-        # calculate derivatives in spectral space
-        psixt, psiyt = self.grad(self.psit)
-        zxt, zyt = self.grad(self.zt)
+    def _nonlinear_terms(self, zt, ubar):
+        """F[∂ψ/∂x], the transformed Jacobian and advection by `ubar`, and the
+        transformed forcing of the vorticity `zt`."""
+        psit = self.psit if zt is self._zt else -self.rksq * zt
 
-        # transform back to physical space for pseudospectral part
-        psix = ift(psixt)
-        psiy = ift(psiyt)
-        zx =   ift(zxt)
-        zy =   ift(zyt)
+        # calculate derivatives in spectral space
+        psixt, psiyt = self.grad(psit)
+        zxt, zyt = self.grad(zt)
+
+        # transform back to physical space for pseudospectral part,
+        # all four fields in one batched transform
+        if self.dealias == '3/2':
+            psix, psiy, zx, zy = self.ift(self._pad(np.stack([psixt, psiyt, zxt, zyt])))
+        elif zt is self._zt and 'velocity' in self._cache:
+            # the velocity of the state is known, from the Courant number
+            u, v = self._cache['velocity']
+            psix, psiy = v, -u
+            zx, zy = self.ift(np.stack([zxt, zyt]))
+        else:
+            psix, psiy, zx, zy = self.ift(np.stack([psixt, psiyt, zxt, zyt]))
+            if zt is self._zt:
+                self._cache['velocity'] = (-psiy, psix)
 
         # Non-linear: calculate the Jacobian in real space
         # and then transform back to spectral space
-        jac = psix * zy - psiy * zx + self.ubar * zx
-        jact = ft(jac)
+        jac = psix * zy - psiy * zx
+        if ubar:
+            jac = jac + ubar * zx
+        jact = self.ft(jac)
+        if self.dealias == '3/2':
+            jact = self._truncate(jact)
 
         force = self.forcing()
         forcet = self.forcingt()
@@ -292,11 +597,27 @@ class BarotropicVorticity(object):
             forcet = 0.0
 
         if force is not None:
-            forcet = forcet + ft(force)
+            forcet = forcet + self.ft(force)
+        return psixt, jact, forcet
 
+    def rhs(self):
+        psixt, jact, forcet = self._nonlinear_terms(self.zt, self.ubar)
         rhs = -jact - self.beta*psixt + forcet
+        if self.r:
+            rhs = rhs - self.r*self.zt
         return rhs
 
+    def nonlinear(self, zt=None):
+        """The terms of the rhs that are stepped explicitly by the 'ifab3'
+        and 'etdrk4' timesteppers: the Jacobian and the forcing, dealiased.
+        By default for the current state."""
+        if zt is None:
+            zt = self.zt
+        _, jact, forcet = self._nonlinear_terms(zt, 0.0)
+        nonlinear = forcet - jact
+        self.anti_alias(nonlinear)
+        return nonlinear
+
 if __name__ == '__main__':
     bv = BarotropicVorticity(n=256, ubar=0.00, beta=8.0)
     # The McWilliams Initial Condition from [McWilliams - J. Fluid Mech. (1984)]
@@ -56,7 +56,9 @@ import numpy as np
 
 from numpy import pi, cos, sin
 from numpy.fft import fftshift, fftfreq
-from numpy.fft.fftpack import rfft2, irfft2
+from numpy.fft import rfft2, irfft2
+
+from forcing import AnnulusForcing
 
 
 ### Configuration
@@ -246,6 +248,10 @@ anti_alias(zt)
 z[:]=ift(zt)
 
 amp = forcing_amp_factor* np.max(np.abs(qi))        # calc a reasonable forcing amplitude
+# white in time forcing of the wavenumbers 14 < K < 20, with the rms
+# amplitude of 0.5*amp*(U[0,1] - 0.5) at the initial dt, scaled by
+# 1/sqrt(dt) as dt changes
+forcing = AnnulusForcing(ksq, dk, amp=0.5*amp/np.sqrt(12.), kmin=14, kmax=20, dt_ref=dt)
 
 # initialise the storage arrays
 time_arr[0]=t
@@ -288,13 +294,6 @@ while t < tmax:
     jac = psix * zy - psiy * zx + ubar * zx
     jact = ft(jac)
 
-    # apply forcing in spectral space by exciting certain wavenumbers
-    # (could also apply some real-space forcing and then convert
-    #   into spectral space before adding to rhs)
-    forcet = np.zeros_like(ksq, dtype=complex)
-    idx = (14 < np.sqrt(ksq)/dk) & (np.sqrt(ksq)/dk < 20)
-    forcet[idx] = 0.5*amp*(np.random.random(ksq.shape)[idx] - 0.5)*np.exp(1j*2.*pi*np.random.random(ksq.shape)[idx])#*(ksq[idx])**(-1./4.)#*np.sin(0.5*t)
-
     # calculate the size of timestep that can be taken
     # (assumes a domain where dx and dy are of the same order)
     c = courant_number(psix, psiy, dx, dt)
@@ -307,6 +306,12 @@ while t < tmax:
 # Possible use of time-varying dissipation, as in Maltrud & Vallis 1991, eq 2.6.
 #   nu = 1.0 * np.sqrt(np.mean(z**2.))/(np.max(k)**(2.*n_diss -2.))
 
+    # apply forcing in spectral space by exciting certain wavenumbers,
+    # drawn for the timestep that is taken
+    # (could also apply some real-space forcing and then convert
+    #   into spectral space before adding to rhs)
+    forcet = forcing.advance(dt)
+
     # take a timestep and diffuse
     rhs = -jact - beta*psixt + forcet - zt*r_rayleigh
     zt[:] = adams_bashforth(zt, rhs, dt)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cost per resolved mode of the dealiasing options of BarotropicVorticity.
+
+    python dealias_benchmark.py [nsteps] [fft backend]
+
+For each resolution the model is stepped with the 2/3 truncation and with the
+3/2 padded Jacobian.  The resolved modes are the wavenumbers of the rfft
+half-plane kept by the dealiasing, so the cost per resolved mode compares
+the options at the same effective resolution.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from baro_vort import BarotropicVorticity
+
+
+def mcwilliams(bv, seed=0):
+    """The McWilliams (1984) initial condition, see baro_vort.py."""
+    rs = np.random.RandomState(seed)
+    ksq = bv.ksq
+    ck = np.sqrt(ksq + (1.0 + (ksq/36.0)**2))**-1
+    piit = rs.randn(*ksq.shape)*ck + 1j*rs.randn(*ksq.shape)*ck
+    pii = bv.ift(piit)
+    piit = bv.ft(pii - pii.mean())
+    bv.zt = -ksq * piit / np.sqrt(0.3)
+
+
+if __name__ == '__main__':
+    nsteps = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    fft = sys.argv[2] if len(sys.argv) > 2 else 'numpy'
+
+    print('%6s %8s %10s %12s %16s' % ('n', 'dealias', 'modes', 'step [ms]', 'ns/mode/step'))
+    for n in (64, 128, 256, 512):
+        for dealias in ('2/3', '3/2'):
+            bv = BarotropicVorticity(n=n, beta=8.0, fft=fft, dealias=dealias)
+            mcwilliams(bv)
+            bv.step()    # start up
+            start = time.time()
+            for _ in range(nsteps):
+                bv.step()
+            elapsed = (time.time() - start) / nsteps
+            modes = int(bv._dealias_filter.sum())
+            print('%6d %8s %10d %12.3f %16.2f' % (n, dealias, modes, elapsed*1e3, elapsed/modes*1e9))
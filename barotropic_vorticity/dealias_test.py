@@ -0,0 +1,57 @@
+"""The 3/2 padded Jacobian of BarotropicVorticity against an exact one.
+
+    python -m pytest dealias_test.py
+
+The vorticity is a sum of modes below a quarter of the maximum wavenumber,
+so the Jacobian is resolved on the model grid and the padded evaluation
+should match it to rounding error, including when the padded size 3n/2
+would be odd (n = 2 mod 4).
+"""
+
+import numpy as np
+
+from baro_vort import BarotropicVorticity
+
+# (k, l, amplitude, phase) of the modes of the vorticity, in wavenumber index
+MODES = [(1, 0, 1.0, 0.3), (0, 2, 0.7, 1.1), (2, 1, 0.5, -0.4), (-1, 3, 0.3, 2.0)]
+
+
+def exact_jacobian(bv):
+    """J(ψ, ζ) = ψ_x ζ_y - ψ_y ζ_x of the modes, on the model grid."""
+    x = bv.Lx * np.arange(bv.nx)[np.newaxis, :] / bv.nx
+    y = bv.Ly * np.arange(bv.ny)[:, np.newaxis] / bv.ny
+    z = zx = zy = psix = psiy = 0.0
+    for i, j, a, p in MODES:
+        k, l = i*bv.dk, j*bv.dl
+        theta = k*x + l*y + p
+        # ψ = - ζ / (k^2 + l^2)
+        b = -a / (k**2 + l**2)
+        z = z + a*np.cos(theta)
+        zx, zy = zx - a*k*np.sin(theta), zy - a*l*np.sin(theta)
+        psix, psiy = psix - b*k*np.sin(theta), psiy - b*l*np.sin(theta)
+    return z, psix*zy - psiy*zx
+
+
+def check_padded_jacobian(nx, ny, L=2.0*np.pi):
+    bv = BarotropicVorticity(n=nx, ny=ny, Lx=L, Ly=1.5*L, dealias='3/2')
+    z, jac = exact_jacobian(bv)
+    bv.z = z
+    psixt, jact, forcet = bv._nonlinear_terms(bv.zt, 0.0)
+    err = np.abs(bv.ift(jact) - jac).max() / np.abs(jac).max()
+    assert err < 1e-12, (nx, ny, bv.nx_padded, bv.ny_padded, err)
+
+
+def test_padded_jacobian():
+    for n in (16, 18, 64, 66):
+        check_padded_jacobian(n, n)
+
+
+def test_padded_jacobian_rectangular():
+    check_padded_jacobian(18, 32)
+    check_padded_jacobian(32, 22)
+
+
+if __name__ == '__main__':
+    test_padded_jacobian()
+    test_padded_jacobian_rectangular()
+    print('ok')
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Stochastic forcing of the spectral vorticity in an annulus of wavenumbers.
+
+Only the coefficients of the forced wavenumbers kmin < K < kmax are drawn,
+so the cost of a step scales with the number of forced modes rather than
+the size of the grid.  The random numbers come from a seeded
+`np.random.Generator`, whose state is saved with the forcing so that a run
+restarted from `get_state()` continues with the same forcing.
+
+    bv = BarotropicVorticity(n=256, beta=8.0)
+    bv.stochastic_forcing = AnnulusForcing(bv.ksq, bv.dk, amp=0.01, tau=0.5, seed=1)
+
+With `tau=None` the forcing is white in time: each step has a new forcing
+with rms amplitude `amp sqrt(dt_ref/dt)`, so that `amp` is the amplitude at
+a step of `dt_ref` and the variance the forcing injects per unit time,
+amp^2 dt_ref, does not depend on the timestep
+
+    F' = amp sqrt(dt_ref/dt) ξ
+
+Otherwise it is an Ornstein-Uhlenbeck process
+with correlation time `tau` and stationary rms amplitude `amp`
+
+    F' = F exp(-dt/tau) + amp sqrt(1 - exp(-2dt/tau)) ξ
+
+where ξ are unit complex Gaussian numbers.  The forcing is drawn by
+`advance(dt)` at the start of each step, for the timestep of that step.
+The Ornstein-Uhlenbeck forcing starts from a draw of its stationary
+distribution, the white forcing from zero.
+
+The spectrum is that of a real field of an even number of points in x:
+in the k = 0 and Nyquist k columns of the rfft spectrum the coefficients
+of l and -l are a conjugate pair, so only those of l > 0 are drawn, and
+the self-conjugate coefficients of l = 0 and the Nyquist l are real.
+"""
+
+import numpy as np
+
+
+class AnnulusForcing(object):
+    """Stochastic forcing of the spectral coefficients with kmin < K < kmax,
+    K being the wavenumber magnitude in units of `dk`.  With `n_members`
+    each member of an ensemble has an independent forcing."""
+    def __init__(self, ksq, dk, amp, kmin=14.0, kmax=20.0, tau=None, seed=None, n_members=None,
+                 dt_ref=1.0):
+        K = np.sqrt(ksq)/dk
+        shape = ((n_members,) if n_members else ()) + np.shape(ksq)
+        self.index = np.flatnonzero(np.broadcast_to((kmin < K) & (K < kmax), shape))
+        self.amp = amp
+        self.tau = tau
+        self.dt_ref = dt_ref
+        self.rng = np.random.default_rng(seed)
+
+        # the k = 0 and Nyquist k columns: the forced modes with real
+        # coefficients, and the flat indices of the l < 0 coefficients and
+        # of their l > 0 conjugates
+        nl, nk = shape[-2:]
+        j, i = np.unravel_index(self.index, shape)[-2:]
+        edge = (i == 0) | (i == nk - 1)
+        self._real = edge & ((j == 0) | (2*j == nl))
+        upper = edge & (0 < j) & (2*j < nl)
+        self._conjugates = self.index[upper]
+        self._mirrors = self.index[upper] + (nl - 2*j[upper])*nk
+
+        # the forcing, zero outside the annulus
+        self.forcet = np.zeros(shape, dtype=np.complex128)
+        if tau is not None:
+            self._set(amp * self._noise())
+
+    @property
+    def nmodes(self):
+        return self.index.size
+
+    def _noise(self):
+        """Unit complex Gaussian numbers for the forced modes, real for
+        the modes with real coefficients."""
+        xi = self.rng.standard_normal((2, self.nmodes))
+        noise = (xi[0] + 1j*xi[1]) / np.sqrt(2.0)
+        noise[self._real] = xi[0, self._real]
+        return noise
+
+    def _set(self, values):
+        self.forcet.flat[self.index] = values
+        self.forcet.flat[self._mirrors] = np.conj(self.forcet.flat[self._conjugates])
+
+    def advance(self, dt):
+        """Draw the forcing for the next step of length `dt`, which may
+        be an array that broadcasts against the forcing."""
+        if np.ndim(dt):
+            dt = np.broadcast_to(dt, self.forcet.shape).flat[self.index]
+        if self.tau is None:
+            self._set(self.amp * np.sqrt(self.dt_ref/dt) * self._noise())
+        else:
+            decay = np.exp(-dt/self.tau)
+            values = self.forcet.flat[self.index]
+            values *= decay
+            values += self.amp * np.sqrt(1.0 - decay**2) * self._noise()
+            self._set(values)
+        return self.forcet
+
+    def get_state(self):
+        """The state of the forcing and its random number generator, for a restart."""
+        return {'rng': self.rng.bit_generator.state,
+                'values': self.forcet.flat[self.index]}
+
+    def set_state(self, state):
+        self.rng.bit_generator.state = state['rng']
+        self._set(state['values'])
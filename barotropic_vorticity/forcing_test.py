@@ -0,0 +1,53 @@
+"""The stochastic AnnulusForcing of the vorticity.
+
+    python -m pytest forcing_test.py
+"""
+
+import numpy as np
+
+from baro_vort import BarotropicVorticity
+from forcing import AnnulusForcing
+
+
+def test_real_field():
+    """The forcing is the spectrum of a real field, including the k = 0
+    and Nyquist k columns, for white and Ornstein-Uhlenbeck forcing."""
+    for n, kmin, kmax in ((64, 14, 20), (16, 7, 12)):
+        bv = BarotropicVorticity(n)
+        for tau in (None, 0.5):
+            forcing = AnnulusForcing(bv.ksq, bv.dk, amp=1.0, kmin=kmin, kmax=kmax,
+                                     tau=tau, seed=1, n_members=2)
+            for i in range(3):
+                forcet = forcing.advance(np.array([0.01, 0.02])[:, np.newaxis, np.newaxis])
+            projected = np.fft.rfft2(np.fft.irfft2(forcet, s=(n, n)))
+            assert np.abs(projected - forcet).max() < 1e-12, (n, tau)
+
+
+def test_white_variance():
+    """The rms of the white forcing scales as 1/sqrt(dt), so the variance
+    injected per unit time does not depend on the timestep."""
+    bv = BarotropicVorticity(64)
+    forcing = AnnulusForcing(bv.ksq, bv.dk, amp=1.0, kmin=4, kmax=30, seed=1, dt_ref=0.1)
+    for dt in (0.1, 0.025):
+        forcet = forcing.advance(dt)
+        rms = np.sqrt(np.mean(np.abs(forcet.flat[forcing.index])**2))
+        assert abs(rms - np.sqrt(0.1/dt)) < 0.05*np.sqrt(0.1/dt), (dt, rms)
+
+
+def test_drawn_for_the_step():
+    """The model draws the forcing of a step for the timestep it takes.
+    From rest the first, forward Euler, step of 'ab3' is the forcing times
+    dt, filtered."""
+    bv = BarotropicVorticity(64)
+    bv.stochastic_forcing = forcing = AnnulusForcing(bv.ksq, bv.dk, amp=1.0, kmin=4, kmax=30,
+                                                     seed=1, dt_ref=0.01)
+    bv.step()
+    expected = bv.dt*forcing.forcet*bv._high_wn_filter*bv._dealias_filter
+    assert np.abs(bv.zt - expected).max() < 1e-12*np.abs(expected).max()
+
+
+if __name__ == '__main__':
+    test_real_field()
+    test_white_variance()
+    test_drawn_for_the_step()
+    print('ok')
@@ -0,0 +1,52 @@
+"""An ensemble BarotropicVorticity against runs of its members one by one.
+
+    python -m pytest members_test.py
+
+With `member_dt` each member has its own timestep, so it should follow the
+single member run from the same initial condition.  The variable-step
+Adams-Bashforth weights are evaluated as arrays over the members, which
+rounds differently from the scalar weights of a single run, so the
+agreement is to round-off rather than bitwise.
+"""
+
+import numpy as np
+
+from baro_vort import BarotropicVorticity
+
+
+def check_members(timestepper, dealias, nsteps=40):
+    # members of different amplitude, so their timesteps differ
+    rng = np.random.default_rng(0)
+    z0 = rng.standard_normal((3, 64, 64)) * np.array([1.0, 2.0, 0.5])[:, np.newaxis, np.newaxis]
+    kwargs = dict(beta=8.0, tau=10.0, timestepper=timestepper, dealias=dealias)
+    ensemble = BarotropicVorticity(64, n_members=3, member_dt=True, **kwargs)
+    ensemble.z = z0
+    singles = []
+    for z in z0:
+        bv = BarotropicVorticity(64, **kwargs)
+        bv.z = z
+        singles.append(bv)
+    for i in range(nsteps):
+        ensemble.step()
+        for bv in singles:
+            bv.step()
+    assert len(set(ensemble.dt)) == 3
+    for member, bv in zip(ensemble.z, singles):
+        err = np.abs(member - bv.z).max() / np.abs(bv.z).max()
+        assert err < 1e-12, (timestepper, dealias, err)
+
+
+def test_members_ab3():
+    check_members('ab3', '2/3')
+    check_members('ab3', '3/2')
+
+
+def test_members_exponential():
+    for timestepper in ('ifab3', 'etdrk4'):
+        check_members(timestepper, '2/3')
+
+
+if __name__ == '__main__':
+    test_members_ab3()
+    test_members_exponential()
+    print('ok')
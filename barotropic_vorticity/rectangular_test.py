@@ -0,0 +1,73 @@
+"""A rectangular BarotropicVorticity against the square model it tiles.
+
+    python -m pytest rectangular_test.py
+
+A domain of two squares, started from a square initial condition repeated
+in x or y, should evolve as the square does: the filters, the initial
+timestep and the Courant number depend on the physical wavenumbers and grid
+spacing, not on the number of points.  There is no beta, whose Rossby waves
+at the longer wavelengths of the larger domain are outside the stability
+region of AB3 at the same timestep.
+"""
+
+import numpy as np
+
+from baro_vort import BarotropicVorticity
+
+
+def initial_vorticity(n, seed=1):
+    """Vorticity of unit maximum in the wavenumber band 20 < K < 31 of the
+    square n^2 model, so the high wavenumber filter acts on it."""
+    bv = BarotropicVorticity(n)
+    K = np.sqrt(bv.ksq)/bv.dk
+    band = (K > 20) & (K < 31)
+    rng = np.random.default_rng(seed)
+    zt = np.zeros(K.shape, dtype=np.complex128)
+    zt[band] = rng.standard_normal(band.sum()) + 1j*rng.standard_normal(band.sum())
+    z = bv.ift(zt)
+    return z / np.abs(z).max()
+
+
+def check_tiled(tiles, timestepper='ab3', dealias='2/3', n=64, nsteps=50):
+    """Run the square model and the domain of `tiles` = (y, x) squares
+    side by side and compare them."""
+    z0 = initial_vorticity(n)
+    square = BarotropicVorticity(n, timestepper=timestepper, dealias=dealias)
+    square.z = z0
+    ty, tx = tiles
+    tiled = BarotropicVorticity(n, nx=tx*n, ny=ty*n, Lx=float(tx), Ly=float(ty),
+                                timestepper=timestepper, dealias=dealias)
+    tiled.z = np.tile(z0, tiles)
+    assert tiled.dt == square.dt
+    for i in range(nsteps):
+        square.step()
+        tiled.step()
+    err = np.abs(tiled.z - np.tile(square.z, tiles)).max() / np.abs(square.z).max()
+    assert err < 1e-10, (tiles, timestepper, dealias, err)
+
+
+def test_wide_ab3():
+    check_tiled((1, 2), dealias='2/3')
+    check_tiled((1, 2), dealias='3/2')
+
+
+def test_tall_ab3():
+    check_tiled((2, 1), dealias='2/3')
+    check_tiled((2, 1), dealias='3/2')
+
+
+def test_filters_tile():
+    """The filters of the wide model are those of the square at the
+    wavenumbers they share, the even x wavenumber indices."""
+    for dealias in ('2/3', '3/2'):
+        square = BarotropicVorticity(64, dealias=dealias)
+        wide = BarotropicVorticity(64, nx=128, ny=64, Lx=2.0, dealias=dealias)
+        assert np.array_equal(wide._dealias_filter[:, ::2], square._dealias_filter)
+        assert np.allclose(wide._high_wn_filter[:, ::2], square._high_wn_filter, rtol=0, atol=1e-14)
+
+
+if __name__ == '__main__':
+    test_wide_ab3()
+    test_tall_ab3()
+    test_filters_tile()
+    print('ok')
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Real two-dimensional Fourier transforms for the pseudospectral models.
+
+The cost of the BarotropicVorticity model is almost all in its transforms,
+so they are done by a transform object that is chosen per model instance:
+
+    'pyfftw'  FFTW plans, cached for each array shape, with aligned buffers
+    'scipy'   scipy.fft, with `workers` threads
+    'numpy'   numpy.fft
+
+`make_transform(backend, workers)` returns the transform, falling back to
+numpy when the backend is not available.  All of them transform over the
+last two axes, so leading axes are transformed together, and count the
+number of 2D transforms they have done in `nfft`.
+"""
+
+import numpy as np
+
+try:
+    import pyfftw
+    PYFFTW = True
+except ImportError:
+    pyfftw = None
+    PYFFTW = False
+
+try:
+    import scipy.fft
+    SCIPY = True
+except ImportError:
+    SCIPY = False
+
+
+BACKENDS = ('pyfftw', 'scipy', 'numpy')
+
+
+class NumpyTransform(object):
+    """Transforms with numpy.fft.  `out`, when given, receives a copy
+    of the result."""
+    backend = 'numpy'
+
+    def __init__(self, workers=1):
+        self.workers = 1
+        self.nfft = 0
+
+    def _count(self, a):
+        self.nfft += int(np.prod(a.shape[:-2]))
+
+    def _result(self, result, out):
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def _stacked(self, fn, a, out):
+        """Apply the 2D transform `fn` to each 2D slice of `a`.  On a single
+        thread a stack is faster transformed slice by slice, which stays in
+        cache, than by one call over the leading axes."""
+        self._count(a)
+        if a.ndim == 2:
+            return self._result(fn(a), out)
+        for idx in np.ndindex(a.shape[:-2]):
+            result = fn(a[idx])
+            if out is None:
+                out = np.empty(a.shape[:-2] + result.shape, dtype=result.dtype)
+            out[idx] = result
+        return out
+
+    def ft(self, phi, out=None):
+        """Go from physical space to spectral space."""
+        return self._stacked(np.fft.rfft2, phi, out)
+
+    def ift(self, psi, out=None):
+        """Go from spectral space to physical space."""
+        return self._stacked(np.fft.irfft2, psi, out)
+
+    def __repr__(self):
+        return '%s(workers=%d)' % (type(self).__name__, self.workers)
+
+
+class ScipyTransform(NumpyTransform):
+    """Transforms with scipy.fft using `workers` threads."""
+    backend = 'scipy'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.nfft = 0
+
+    def _stacked(self, fn, a, out):
+        if self.workers == 1:
+            return super(ScipyTransform, self)._stacked(fn, a, out)
+        # the threads share out the transforms of a stack
+        self._count(a)
+        return self._result(fn(a, axes=(-2, -1), workers=self.workers), out)
+
+    def ft(self, phi, out=None):
+        return self._stacked(scipy.fft.rfft2, phi, out)
+
+    def ift(self, psi, out=None):
+        return self._stacked(scipy.fft.irfft2, psi, out)
+
+
+class FFTWTransform(NumpyTransform):
+    """Transforms with FFTW.  A plan and a pair of aligned buffers is made
+    the first time an array shape is transformed, and reused after that.
+    The result is written into `out` when given, otherwise it is a copy
+    of the output buffer of the plan.  The inverse plans assume an even
+    number of points in the last axis, as the models use."""
+    backend = 'pyfftw'
+    flags = ('FFTW_MEASURE', 'FFTW_DESTROY_INPUT')
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.nfft = 0
+        self._plans = {}
+
+    def _plan(self, shape, direction):
+        key = (shape, direction)
+        plan = self._plans.get(key)
+        if plan is None:
+            if direction == 'FFTW_FORWARD':
+                a = pyfftw.empty_aligned(shape, dtype=np.float64)
+                b = pyfftw.empty_aligned(shape[:-1] + (shape[-1]//2 + 1,), dtype=np.complex128)
+            else:
+                a = pyfftw.empty_aligned(shape, dtype=np.complex128)
+                b = pyfftw.empty_aligned(shape[:-1] + (2*(shape[-1] - 1),), dtype=np.float64)
+            plan = self._plans[key] = pyfftw.FFTW(a, b, axes=(-2, -1), direction=direction,
+                                                  flags=self.flags, threads=self.workers)
+        return plan
+
+    def _execute(self, plan, a, out):
+        plan.input_array[...] = a
+        plan()
+        if out is None:
+            return plan.output_array.copy()
+        out[...] = plan.output_array
+        return out
+
+    def ft(self, phi, out=None):
+        self._count(phi)
+        return self._execute(self._plan(phi.shape, 'FFTW_FORWARD'), phi, out)
+
+    def ift(self, psi, out=None):
+        self._count(psi)
+        return self._execute(self._plan(psi.shape, 'FFTW_BACKWARD'), psi, out)
+
+
+def make_transform(backend='numpy', workers=1):
+    """The transform for `backend`, one of BACKENDS, with `workers` threads.
+    Falls back to numpy when the backend is not available."""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown FFT backend '%s', use one of %s" % (backend, ', '.join(BACKENDS)))
+    if backend == 'pyfftw':
+        if PYFFTW:
+            return FFTWTransform(workers)
+        print("WARNING: pyfftw not available.  Falling back to numpy")
+    elif backend == 'scipy':
+        if SCIPY:
+            return ScipyTransform(workers)
+        print("WARNING: scipy.fft not available.  Falling back to numpy")
+    return NumpyTransform(workers)
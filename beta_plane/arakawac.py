@@ -4,6 +4,15 @@
 import numpy as np
 #import xarray as xr
 
+
+def _object_array(*fields):
+    """Collect differently shaped fields into a 1D object array without copying them."""
+    arr = np.empty(len(fields), dtype=object)
+    for i, field in enumerate(fields):
+        arr[i] = field
+    return arr
+
+
 class Arakawa1D(object):
     def __init__(self, nx, Lx):
         super(Arakawa1D, self).__init__()
@@ -14,8 +23,8 @@ class Arakawa1D(object):
         # +-------+    * (nx, ny)   phi points at grid centres
         # u  phi  u    * (nx+1, ny) u points on vertical edges  (u[0] and u[nx] are boundary values)
         # +-------+
-        self._u = np.zeros((nx+3), dtype=np.float)
-        self._phi = np.zeros((nx+2), dtype=np.float)
+        self._u = np.zeros((nx+3), dtype=np.float64)
+        self._phi = np.zeros((nx+2), dtype=np.float64)
 
         self.dx = dx = float(Lx) / nx
 
@@ -34,7 +43,7 @@ class Arakawa1D(object):
 
     @property
     def state(self):
-        return np.array([self.u, self.phi])
+        return _object_array(self.u, self.phi)
 
     @state.setter
     def state(self, value):
@@ -66,7 +75,7 @@ class Arakawa1D(object):
         If psi has shape (nx, ny), returns an array of shape (nx-1, ny)."""
         return 0.5*(psi[:-1] + psi[1:])
 
-    def _apply_boundary_conditions(self):
+    def apply_boundary_conditions(self):
         # left and right-hand boundary values the same for u
         # u[0] = u[nx]
         # copy u[dx] to u[nx+dx]
@@ -81,23 +90,40 @@ class Arakawa1D(object):
         self._phi[0] = self._phi[-2]
         self._phi[-1] = self._phi[1]
 
+    _apply_boundary_conditions = apply_boundary_conditions
+
 class ArakawaCGrid(object):
-    def __init__(self, nx, ny, Lx, Ly):
+    def __init__(self, nx, ny, Lx, Ly, workspace=False, n_members=None):
         super(ArakawaCGrid, self).__init__()
         self.nx = nx
         self.ny = ny
         self.Lx = Lx
         self.Ly = Ly
 
+        # An ensemble of `n_members` grids can be held with a leading
+        # member axis on all fields, e.g. phi has shape (n_members, nx, ny).
+        # All operators and boundary conditions act on the last two axes.
+        self.n_members = n_members
+        members = (n_members,) if n_members else ()
+
+        # In workspace mode the finite-difference operators write into
+        # scratch arrays owned by the grid (see `_work`) rather than
+        # allocating new arrays on every call.
+        self.workspace = workspace
+        self._workspace = {}
+        self._dstate = None
+
         # Arakawa-C grid
         # +-- v --+
         # |       |    * (nx, ny)   phi points at grid centres
         # u  phi  u    * (nx+1, ny) u points on vertical edges  (u[0] and u[nx] are boundary values)
         # |       |    * (nx, ny+1) v points on horizontal edges
         # +-- v --+
-        self._u = np.zeros((nx+3, ny+2), dtype=np.float)
-        self._v = np.zeros((nx+2, ny+3), dtype=np.float)
-        self._phi = np.zeros((nx+2, ny+2), dtype=np.float)
+        #
+        # u, v and phi, including their halos, are stored one after the other
+        # in a single contiguous buffer: `_u`, `_v` and `_phi` are views into it.
+        self._shapes = (members + (nx+3, ny+2), members + (nx+2, ny+3), members + (nx+2, ny+2))
+        self._bind_buffer(np.zeros(sum(np.prod(s) for s in self._shapes), dtype=np.float64))
 
         self.dx = dx = float(Lx) / nx
         self.dy = dy = float(Ly) / ny
@@ -128,19 +154,21 @@ class ArakawaCGrid(object):
     # define u, v and h properties to return state without the boundaries
     @property
     def u(self):
-        return self._u[1:-1, 1:-1]
+        return self._u[..., 1:-1, 1:-1]
 
     @property
     def v(self):
-        return self._v[1:-1, 1:-1]
+        return self._v[..., 1:-1, 1:-1]
 
     @property
     def phi(self):
-        return self._phi[1:-1, 1:-1]
+        return self._phi[..., 1:-1, 1:-1]
 
     @property
     def state(self):
-        return np.array([self.u, self.v, self.phi])
+        # u, v and phi have different shapes, so the state is an object
+        # array of views onto the buffer: no data is copied
+        return _object_array(self.u, self.v, self.phi)
 
     @state.setter
     def state(self, value):
@@ -149,61 +177,155 @@ class ArakawaCGrid(object):
         self.v[:] = v
         self.phi[:] = phi
 
+    @property
+    def flat_state(self):
+        """The packed u, v and phi buffer, including halos, as a 1D array.
+
+        This is a view of the model state, not a copy.  A checkpoint of the
+        whole state is a single copy of it:
+
+            saved = sw.flat_state.copy()
+            ...
+            sw.flat_state = saved
+        """
+        return self._buffer
+
+    @flat_state.setter
+    def flat_state(self, value):
+        self._buffer[:] = value
+
+    def _bind_buffer(self, buffer):
+        """Use the 1D array `buffer` as the storage for u, v and phi (including halos).
+        The field offsets in the buffer are fixed by `_shapes`."""
+        fields = []
+        offset = 0
+        for shape in self._shapes:
+            size = int(np.prod(shape))
+            fields.append(buffer[offset:offset+size].reshape(shape))
+            offset += size
+        self._buffer = buffer
+        self._u, self._v, self._phi = fields
+
+    def _member_param(self, value):
+        """Shape a model parameter to broadcast against the fields.
+        A sequence of `n_members` values gives one value per ensemble member;
+        scalars are shared by all members and are returned unchanged."""
+        if self.n_members and np.ndim(value) == 1:
+            return np.asarray(value, dtype=float).reshape(-1, 1, 1)
+        return value
+
+    def _work(self, name, shape):
+        """Return the scratch array `name` of the given shape from the workspace.
+
+        Returns None when workspace mode is off, so that an operator called
+        with `out=self._work(...)` allocates a new array as usual."""
+        if not self.workspace:
+            return None
+        key = (name, shape)
+        buf = self._workspace.get(key)
+        if buf is None:
+            buf = self._workspace[key] = np.empty(shape, dtype=np.float64)
+        return buf
+
+    def _empty_state(self):
+        return _object_array(np.empty_like(self.u), np.empty_like(self.v), np.empty_like(self.phi))
+
+    def _tendency(self):
+        """Return a (u, v, phi) state array to write tendencies into.
+        A timestepper that keeps a history of tendencies can provide the
+        storage, see `AdamsBashforth`.  Otherwise, in workspace mode the
+        same preallocated arrays are returned on every call, so the result
+        is only valid until the next call."""
+        storage = getattr(self, '_tendency_storage', None)
+        if storage is not None:
+            storage = storage()
+            if storage is not None:
+                return storage
+        if not self.workspace:
+            return self._empty_state()
+        if self._dstate is None:
+            self._dstate = self._empty_state()
+        return self._dstate
+
     # Define finite-difference methods on the grid
-    def diffx(self, psi):
+    # All operators take an optional `out` array of the correct shape
+    # to write the result into.
+    def diffx(self, psi, out=None):
         """Calculate ∂/∂x[psi] over a single grid square.
 
         i.e. d/dx(psi)[i,j] = (psi[i+1/2, j] - psi[i-1/2, j]) / dx
 
         The derivative is returned at x points at the midpoint between
         x points of the input array."""
-        return (psi[1:,:] - psi[:-1,:]) / self.dx
+        out = np.subtract(psi[..., 1:, :], psi[..., :-1, :], out=out)
+        out /= self.dx
+        return out
 
-    def diffy(self, psi):
+    def diffy(self, psi, out=None):
         """Calculate ∂/∂y[psi] over a single grid square.
 
         i.e. d/dy(psi)[i,j] = (psi[i, j+1/2] - psi[i, j-1/2]) / dy
 
         The derivative is returned at y points at the midpoint between
         y points of the input array."""
-        return (psi[:, 1:] - psi[:,:-1]) / self.dy
+        out = np.subtract(psi[..., 1:], psi[..., :-1], out=out)
+        out /= self.dy
+        return out
 
-    def del2(self, psi):
+    def del2(self, psi, out=None):
         """Returns the Laplacian of psi."""
-        return self.diff2x(psi)[:, 1:-1] + self.diff2y(psi)[1:-1, :]
+        out = self.diff2x(psi[..., 1:-1], out=out)
+        out += self.diff2y(psi[..., 1:-1, :], out=self._work('del2', out.shape))
+        return out
 
-    def diff2x(self, psi):
+    def diff2x(self, psi, out=None):
         """Calculate ∂2/∂x2[psi] over a single grid square.
 
         i.e. d2/dx2(psi)[i,j] = (psi[i+1, j] - psi[i, j] + psi[i-1, j]) / dx^2
 
         The derivative is returned at the same x points as the
         x points of the input array, with dimension (nx-2, ny)."""
-        return (psi[:-2, :] - 2*psi[1:-1, :] + psi[2:, :]) / self.dx**2
+        out = np.multiply(psi[..., 1:-1, :], -2.0, out=out)
+        out += psi[..., :-2, :]
+        out += psi[..., 2:, :]
+        out /= self.dx**2
+        return out
 
-    def diff2y(self, psi):
+    def diff2y(self, psi, out=None):
         """Calculate ∂2/∂y2[psi] over a single grid square.
 
         i.e. d2/dy2(psi)[i,j] = (psi[i, j+1] - psi[i, j] + psi[i, j-1]) / dy^2
 
         The derivative is returned at the same y points as the
         y points of the input array, with dimension (nx, ny-2)."""
-        return (psi[:, :-2] - 2*psi[:, 1:-1] + psi[:, 2:]) / self.dy**2
+        out = np.multiply(psi[..., 1:-1], -2.0, out=out)
+        out += psi[..., :-2]
+        out += psi[..., 2:]
+        out /= self.dy**2
+        return out
 
-    def centre_average(self, psi):
+    def centre_average(self, psi, out=None):
         """Returns the four-point average at the centres between grid points.
         If psi has shape (nx, ny), returns an array of shape (nx-1, ny-1)."""
-        return 0.25*(psi[:-1,:-1] + psi[:-1,1:] + psi[1:, :-1] + psi[1:,1:])
+        out = np.add(psi[..., :-1, :-1], psi[..., :-1, 1:], out=out)
+        out += psi[..., 1:, :-1]
+        out += psi[..., 1:, 1:]
+        out *= 0.25
+        return out
 
-    def y_average(self, psi):
+    def y_average(self, psi, out=None):
         """Average adjacent values in the y dimension.
         If psi has shape (nx, ny), returns an array of shape (nx, ny-1)."""
-        return 0.5*(psi[:,:-1] + psi[:,1:])
+        out = np.add(psi[..., :-1], psi[..., 1:], out=out)
+        out *= 0.5
+        return out
 
-    def x_average(self, psi):
+    def x_average(self, psi, out=None):
         """Average adjacent values in the x dimension.
         If psi has shape (nx, ny), returns an array of shape (nx-1, ny)."""
-        return 0.5*(psi[:-1,:] + psi[1:,:])
+        out = np.add(psi[..., :-1, :], psi[..., 1:, :], out=out)
+        out *= 0.5
+        return out
 
     def divergence(self):
         """Returns the horizontal divergence at h points."""
@@ -211,7 +333,7 @@ class ArakawaCGrid(object):
 
     def vorticity(self):
         """Returns the vorticity at grid corners."""
-        return self.diffy(self.u)[1:-1, :] - self.diffx(self.v)[:, 1:-1]
+        return self.diffy(self.u)[..., 1:-1, :] - self.diffx(self.v)[..., 1:-1]
 
     def uvath(self):
         """Calculate the value of u at h points (cell centres)."""
@@ -221,16 +343,16 @@ class ArakawaCGrid(object):
 
     def uvatuv(self):
         """Calculate the value of u at v and v at u."""
-        ubar = self.centre_average(self._u)[1:-1, :]  # (nx, ny+1)
-        vbar = self.centre_average(self._v)[:, 1:-1]  # (nx+1, ny)
+        ubar = self.centre_average(self._u)[..., 1:-1, :]  # (nx, ny+1)
+        vbar = self.centre_average(self._v)[..., 1:-1]  # (nx+1, ny)
         return ubar, vbar
 
     def _fix_boundary_corners(self, field):
         # fix corners to be average of neighbours
-        field[0, 0] =  0.5*(field[1, 0] + field[0, 1])
-        field[-1, 0] = 0.5*(field[-2, 0] + field[-1, 1])
-        field[0, -1] = 0.5*(field[1, -1] + field[0, -2])
-        field[-1, -1] = 0.5*(field[-1, -2] + field[-2, -1])
+        field[..., 0, 0] =  0.5*(field[..., 1, 0] + field[..., 0, 1])
+        field[..., -1, 0] = 0.5*(field[..., -2, 0] + field[..., -1, 1])
+        field[..., 0, -1] = 0.5*(field[..., 1, -1] + field[..., 0, -2])
+        field[..., -1, -1] = 0.5*(field[..., -1, -2] + field[..., -2, -1])
 
     # def apply_boundary_conditions(self):
     #     """Set the boundary values of the u v and phi fields.
@@ -255,32 +377,32 @@ class PeriodicBoundaries:
         # copy u[dx] to u[nx+dx]
         # and u[nx-dx] to u[-dx]
         # to simulate periodic continuity
-        self._u[0, :] = self._u[-3, :]
-        self._u[1, :] = self._u[-2, :]
-        self._u[-1, :] = self._u[2, :]
+        self._u[..., 0, :] = self._u[..., -3, :]
+        self._u[..., 1, :] = self._u[..., -2, :]
+        self._u[..., -1, :] = self._u[..., 2, :]
 
         # other fields are not on boundary
         # so just simulate periodic continuity
-        self._v[0, :] = self._v[-2, :]
-        self._v[-1, :] = self._v[1, :]
-        self._phi[0, :] = self._phi[-2, :]
-        self._phi[-1, :] = self._phi[1, :]
+        self._v[..., 0, :] = self._v[..., -2, :]
+        self._v[..., -1, :] = self._v[..., 1, :]
+        self._phi[..., 0, :] = self._phi[..., -2, :]
+        self._phi[..., -1, :] = self._phi[..., 1, :]
 
         # top and bottom boundaries: zero derivative
         fields = self._u, self._v, self._phi
         for field in fields:
-            field[:, 0] = field[:, 1]
-            field[:, -1] = field[:, -2]
+            field[..., 0] = field[..., 1]
+            field[..., -1] = field[..., -2]
             self._fix_boundary_corners(field)
 
     def apply_boundary_conditions_to(self, field):
         # periodic boundary in the x-direction
-        field[0, :] = field[-2, :]
-        field[-1, :] = field[1, :]
+        field[..., 0, :] = field[..., -2, :]
+        field[..., -1, :] = field[..., 1, :]
 
         # top and bottom boundaries: zero derivative
-        field[:, 0] = field[:, 1]
-        field[:, -1] = field[:, -2]
+        field[..., 0] = field[..., 1]
+        field[..., -1] = field[..., -2]
 
         self._fix_boundary_corners(field)
 
@@ -292,31 +414,31 @@ class WallBoundaries:
     """
     def apply_boundary_conditions(self):
         # No flow through the boundary at x=0
-        self._u[0, :] = 0
-        self._u[1, :] = 0
-        self._u[-1, :] = 0
-        self._u[-2, :] = 0
+        self._u[..., 0, :] = 0
+        self._u[..., 1, :] = 0
+        self._u[..., -1, :] = 0
+        self._u[..., -2, :] = 0
 
         # free-slip of other variables: zero-derivative
-        self._v[0, :] = self._v[1, :]
-        self._v[-1, :] = self._v[-2, :]
-        self._phi[0, :] = self._phi[1, :]
-        self._phi[-1, :] = self._phi[-2, :]
+        self._v[..., 0, :] = self._v[..., 1, :]
+        self._v[..., -1, :] = self._v[..., -2, :]
+        self._phi[..., 0, :] = self._phi[..., 1, :]
+        self._phi[..., -1, :] = self._phi[..., -2, :]
 
         fields = self._u, self._v, self._phi
         # top and bottom boundaries: zero deriv
         for field in fields:
-            field[:, 0] = field[:, 1]
-            field[:, -1] = field[:, -2]
+            field[..., 0] = field[..., 1]
+            field[..., -1] = field[..., -2]
             self._fix_boundary_corners(field)
 
     def apply_boundary_conditions_to(self, field):
         # free slip on left and right boundares: zero derivative
-        field[0, :] = field[1, :]
-        field[-1, :] = field[-2, :]
+        field[..., 0, :] = field[..., 1, :]
+        field[..., -1, :] = field[..., -2, :]
 
         # top and bottom boundaries: zero deriv and damping
-        field[:, 0] = field[:, 1]
-        field[:, -1] = field[:, -2]
+        field[..., 0] = field[..., 1]
+        field[..., -1] = field[..., -2]
 
         self._fix_boundary_corners(field)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Shared-memory domain decomposition of the ShallowWater models.
+
+The grid is split into strips of latitude, each of which is stepped by
+a separate worker process.  The halo-padded u, v and phi arrays of the
+model are moved into a `multiprocessing.shared_memory` block, so every
+worker reads the one-cell halos of its strip directly from its neighbours'
+rows: the halo exchange is the synchronisation between the phases of a step
+
+    1. rank 0 applies the model's boundary conditions to the whole grid
+    2. every worker calculates the new state of its strip
+    3. every worker writes the new state of the rows it owns
+
+with a barrier between each phase.  The strips are evaluated with the
+model's own `_dynamics_terms` and timestepper on views of the shared arrays,
+so the decomposed model gives the same result as the serial model.
+
+    sw = PeriodicShallowWater(nx, ny, ...)
+    with DecomposedShallowWater(sw, nworkers=4) as dsw:
+        dsw.advance(1000)
+    # sw now holds the state after 1000 steps
+
+Forcings, tracers and the SemiImplicit models are not supported.  A subclass overriding `rhs()`
+must work on a strip of the grid: it is called with the strip model.
+"""
+
+import time
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from shallowwater import ShallowWater
+from semiimplicit import SemiImplicit
+
+
+def _strip_bounds(ny, nstrips):
+    """Split `ny` latitudes into `nstrips` contiguous (j0, j1) ranges."""
+    edges = np.linspace(0, ny, nstrips+1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _strip_model(model, j0, j1):
+    """A copy of `model` whose fields are views of latitudes [j0, j1) of the
+    model's fields, plus one halo row either side.  The strip has
+    `j1-j0` rows of u and phi and `j1-j0+1` rows of v."""
+    strip = object.__new__(type(model))
+    strip.__dict__.update(model.__dict__)
+
+    strip.ny = j1 - j0
+    strip._u = model._u[..., j0:j1+2]
+    strip._v = model._v[..., j0:j1+3]
+    strip._phi = model._phi[..., j0:j1+2]
+    strip._buffer = None
+
+    strip.uy = strip.phiy = model.uy[:, j0:j1]
+    strip.vy = model.vy[:, j0:j1+1]
+    if hasattr(model, 'hy'):
+        strip.hy = strip.phiy
+
+    # the sponge layers are at the edges of the full domain, not the strip
+    strip._sponge_profiles = {
+        j1 - j0: model._sponge_profile(model.ny)[j0:j1],
+        j1 - j0 + 1: model._sponge_profile(model.ny+1)[j0:j1+1],
+    }
+    strip._workspace = {}
+    strip._dstate = None
+    strip._increment = None
+
+    # continue the Adams-Bashforth history of the model
+    strip.set_history([(dt, _owned_rows(du, dv, dphi, j0, j1, j1-j0+1))
+                            for dt, (du, dv, dphi) in model.get_history()])
+    return strip
+
+
+def _owned_rows(u, v, phi, j0, j1, nv):
+    """Slice latitudes [j0, j1) of u and phi and [j0, j0+nv) of v."""
+    state = np.empty(3, dtype=object)
+    state[0], state[1], state[2] = u[..., j0:j1], v[..., j0:j0+nv], phi[..., j0:j1]
+    return state
+
+
+def _worker(model, shm_name, rank, bounds, barrier, conn):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    strip = None
+    try:
+        model._bind_buffer(np.ndarray(model._buffer.shape, dtype=model._buffer.dtype, buffer=shm.buf))
+        j0, j1 = bounds[rank]
+        last = rank == len(bounds) - 1
+        strip = _strip_model(model, j0, j1)
+        # v has one more latitude than u and phi: the last strip owns it
+        nv = j1 - j0 + 1 if last else j1 - j0
+
+        while True:
+            command = conn.recv()
+            if command[0] == 'advance':
+                for _ in range(command[1]):
+                    if rank == 0:
+                        model.apply_boundary_conditions()
+                    barrier.wait()
+
+                    du, dv, dphi = strip.state + strip.dstate()
+                    barrier.wait()
+
+                    model.u[..., j0:j1] = du
+                    model.v[..., j0:j0+nv] = dv[..., :nv]
+                    model.phi[..., j0:j1] = dphi
+                    strip._incr_timestep()
+                    barrier.wait()
+                conn.send(('done',))
+            elif command[0] == 'history':
+                history = [(dt, _owned_rows(du, dv, dphi, 0, j1-j0, nv))
+                                for dt, (du, dv, dphi) in strip.get_history()]
+                conn.send(('history', history))
+            elif command[0] == 'close':
+                break
+    except Exception:
+        barrier.abort()
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        # release the views of the shared memory before closing it
+        model = strip = None
+        shm.close()
+
+
+class DecomposedShallowWater(object):
+    """Step a ShallowWater model over `nworkers` processes, each owning
+    a strip of latitudes of the grid.
+
+    The model's state is moved into shared memory while the decomposition
+    is open: the model object can be inspected between calls to `advance`.
+    Call `close()`, or use as a context manager, to return the state
+    and the timestepping history to the model.
+    """
+    def __init__(self, model, nworkers, context=None):
+        if not isinstance(model, ShallowWater):
+            raise TypeError('Only ShallowWater models can be decomposed')
+        if model.forcings or model.tracers:
+            raise ValueError('Forcings and tracers are not supported by the decomposed model')
+        if model.cfl is not None:
+            raise ValueError('Adaptive timestepping is not supported by the decomposed model')
+        if isinstance(model, SemiImplicit):
+            raise ValueError('The Helmholtz solve of a SemiImplicit model needs the whole grid')
+        if not 1 <= nworkers <= model.ny:
+            raise ValueError('nworkers must be between 1 and ny')
+
+        self.model = model
+        self.nworkers = nworkers
+        self.bounds = _strip_bounds(model.ny, nworkers)
+
+        buffer = model._buffer
+        self._shm = shared_memory.SharedMemory(create=True, size=buffer.nbytes)
+        shared = np.ndarray(buffer.shape, dtype=buffer.dtype, buffer=self._shm.buf)
+        shared[:] = buffer
+        model._bind_buffer(shared)
+
+        ctx = context or multiprocessing.get_context()
+        self._barrier = ctx.Barrier(nworkers)
+        self._conns = []
+        self._procs = []
+        for rank in range(nworkers):
+            conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_worker,
+                    args=(model, self._shm.name, rank, self.bounds, self._barrier, child_conn))
+            p.daemon = True
+            p.start()
+            self._conns.append(conn)
+            self._procs.append(p)
+
+    def _send(self, *command):
+        for conn in self._conns:
+            conn.send(command)
+        replies = []
+        for rank, (conn, p) in enumerate(zip(self._conns, self._procs)):
+            while not conn.poll(1.0):
+                if not p.is_alive():
+                    self._terminate()
+                    raise RuntimeError('Worker process %d exited unexpectedly' % rank)
+            replies.append(conn.recv())
+        for reply in replies:
+            if reply[0] == 'error':
+                self._terminate()
+                raise RuntimeError('Worker process failed:\n' + reply[1])
+        return replies
+
+    def advance(self, nsteps):
+        """Take `nsteps` steps forward in time."""
+        self._send('advance', nsteps)
+        for _ in range(nsteps):
+            self.model._incr_timestep()
+
+    def step(self):
+        self.advance(1)
+
+    def close(self):
+        """Stop the workers and return the state to the model."""
+        if self._shm is None:
+            return
+        model = self.model
+        replies = self._send('history')
+        history = []
+        for n, (dt, _) in enumerate(replies[0][1]):
+            fstate = np.empty(3, dtype=object)
+            for k in range(3):
+                fstate[k] = np.concatenate([reply[1][n][1][k] for reply in replies], axis=-1)
+            history.append((dt, fstate))
+        model.set_history(history)
+        for conn in self._conns:
+            conn.send(('close',))
+        for p in self._procs:
+            p.join()
+        self._release()
+
+    def _terminate(self):
+        for p in self._procs:
+            p.terminate()
+        self._release()
+
+    def _release(self):
+        self.model._bind_buffer(self.model._buffer.copy())
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    # Strong scaling report: a fixed size problem on 1..N workers
+    import sys
+    from shallowwater import PeriodicShallowWater
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    nsteps = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    def initial_model():
+        sw = PeriodicShallowWater(n, n+1, beta=2.0e-11, dt=1000.0, nu=1.0e3, workspace=True)
+        d = n // 8
+        hump = (np.sin(np.linspace(0, np.pi, 2*d))**2)[np.newaxis, :] * (np.sin(np.linspace(0, np.pi, 2*d))**2)[:, np.newaxis]
+        sw.phi[:] = 10.0
+        sw.phi[n//2-d:n//2+d, n//2-d:n//2+d] += hump
+        return sw
+
+    # the first steps are the Euler and AB2 start up of AB3, and compile
+    # the numba kernels of the timestepper: time both models after them
+    warmup = 3
+    if nsteps <= warmup:
+        raise SystemExit('Time more than %d steps' % warmup)
+
+    serial = initial_model()
+    for _ in range(warmup):
+        serial.step()
+    start = time.time()
+    for _ in range(nsteps-warmup):
+        serial.step()
+    serial_time = (time.time() - start) * nsteps / (nsteps-warmup)
+
+    print('Strong scaling: %dx%d grid, %d steps' % (n, n+1, nsteps))
+    print('serial:    %8.3f s' % serial_time)
+    print('%8s %10s %8s %10s %12s' % ('workers', 'time [s]', 'speedup', 'efficiency', 'max |diff|'))
+    for nworkers in range(1, max_workers+1):
+        sw = initial_model()
+        with DecomposedShallowWater(sw, nworkers) as dsw:
+            dsw.advance(warmup)  # start up the workers
+            start = time.time()
+            dsw.advance(nsteps-warmup)
+            elapsed = (time.time() - start) * nsteps / (nsteps-warmup)
+        diff = max(np.abs(a - b).max() for a, b in zip(sw.state, serial.state))
+        speedup = serial_time / elapsed
+        print('%8d %10.3f %8.2f %10.2f %12.3g' % (nworkers, elapsed, speedup, speedup/nworkers, diff))
@@ -4,7 +4,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from shallowwater import PeriodicShallowWater
-from spectral_analysis import background, kiladis_spectra
+from spectral_analysis import background, WelchKiladisSpectra
 
 if __name__ == '__main__':
     nx = 128
@@ -46,20 +46,15 @@ if __name__ == '__main__':
     en = []
     qn = []
 
-    eq_reg = []
-    ts = []
+    # power spectra of u about the equator, sampled every 10 steps
+    spectra = WelchKiladisSpectra(256, dt=10*dt)
 
     plt.show()
     for i in range(100000):
         ocean.step()
 
         if i % 10 == 0:
-            eq = ocean.u.copy()[:, ny//2-5:ny//2+5]
-            eq_reg.append(eq)
-            ts.append(ocean.t)
-
-            eq_reg = eq_reg[-1000:]
-            ts = ts[-1000:]
+            spectra.append(ocean.u[:, ny//2-5:ny//2+5])
 
         if i % 100 == 0:
 
@@ -80,13 +75,13 @@ if __name__ == '__main__':
             plt.title('Geopotential Loss')
 
             plt.subplot(233)
-            if len(ts) > 50:
-                specs = kiladis_spectra(eq_reg)
-                spec = np.sum(specs, axis=0)
+            if spectra.nsegments:
+                # power summed over the latitudes
+                spec = spectra.power.sum(axis=0)
                 nw, nk = spec.shape
                 fspec = np.fft.fftshift(spec)
                 fspec -= background(fspec, 10, 0)
-                om = np.fft.fftshift(np.fft.fftfreq(nw, ts[1]-ts[0]))
+                om = np.fft.fftshift(spectra.frequencies())
                 k = np.fft.fftshift(np.fft.fftfreq(nk, 1.0/nk))
                 plt.pcolormesh(k, om, np.log(1+np.abs(fspec)), cmap=plt.cm.bone)
                 plt.xlim(-15, 15)
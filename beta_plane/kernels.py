@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Fused stencil kernels for the shallow water tendencies.
+
+Each kernel calculates the complete u, v and phi (or h) tendencies in a single
+pass over the grid, instead of the sequence of whole-array operations used by
+the NumPy implementation in `shallowwater.py`.  The kernels are compiled with
+Numba when it is available; `NUMBA` is False otherwise and the models fall back
+to the NumPy implementation.
+
+Index conventions follow the halo-padded arrays of the ArakawaCGrid:
+
+    u[i, j] = _u[i+1, j+1]      i in [0, nx],   j in [0, ny-1]
+    v[i, j] = _v[i+1, j+1]      i in [0, nx-1], j in [0, ny]
+    phi[i, j] = _phi[i+1, j+1]  i in [0, nx-1], j in [0, ny-1]
+
+`wu` and `wv` are the Rayleigh damping rates of the sponge layers
+at each u and v latitude, see `ShallowWater.damping`.
+
+`combine2` and `combine3` form the linear combinations of the tendencies
+for the Adams-Bashforth timesteppers, see `timesteppers.py`.
+"""
+
+try:
+    import numba
+    NUMBA = True
+except ImportError:
+    numba = None
+    NUMBA = False
+
+
+def _jit(fn):
+    if NUMBA:
+        return numba.njit(cache=True)(fn)
+    return fn
+
+
+@_jit
+def nonlinear_tendency(_u, _v, _phi, fu, fv, nu, nu_phi, wu, wv, dx, dy, u_rhs, v_rhs, phi_rhs):
+    """Nonlinear shallow water tendencies, see `ShallowWater._dynamics_terms`.
+    `fu` and `fv` are the Coriolis parameter at the u and v latitudes."""
+    nx, ny = phi_rhs.shape
+    rdx2 = 1.0 / dx**2
+    rdy2 = 1.0 / dy**2
+
+    for i in range(nx+1):
+        for j in range(ny+1):
+            # the height equation
+            if i < nx and j < ny:
+                fluxw = 0.5*(_phi[i, j+1] + _phi[i+1, j+1]) * _u[i+1, j+1]
+                fluxe = 0.5*(_phi[i+1, j+1] + _phi[i+2, j+1]) * _u[i+2, j+1]
+                fluxs = 0.5*(_phi[i+1, j] + _phi[i+1, j+1]) * _v[i+1, j+1]
+                fluxn = 0.5*(_phi[i+1, j+1] + _phi[i+1, j+2]) * _v[i+1, j+2]
+                p = _phi[i+1, j+1]
+                d2x = (_phi[i, j+1] - 2.0*p + _phi[i+2, j+1]) * rdx2
+                d2y = (_phi[i+1, j] - 2.0*p + _phi[i+1, j+2]) * rdy2
+                phi_rhs[i, j] = -(fluxe - fluxw)/dx - (fluxn - fluxs)/dy + nu_phi*(d2x + d2y)
+
+            # the u equation
+            if j < ny:
+                u = _u[i+1, j+1]
+                dhdx = (_phi[i+1, j+1] - _phi[i, j+1]) / dx
+                v_at_u = 0.25*(_v[i, j+1] + _v[i, j+2] + _v[i+1, j+1] + _v[i+1, j+2])
+                d2x = (_u[i, j+1] - 2.0*u + _u[i+2, j+1]) * rdx2
+                d2y = (_u[i+1, j] - 2.0*u + _u[i+1, j+2]) * rdy2
+                ubarw = 0.5*(_u[i, j+1] + u)
+                ubare = 0.5*(u + _u[i+2, j+1])
+                ududx = 0.5*(ubare**2 - ubarw**2) / dx
+                ubars = 0.5*(_u[i+1, j] + u)
+                ubarn = 0.5*(u + _u[i+1, j+2])
+                vdudy = v_at_u*(ubarn - ubars) / dy
+                u_rhs[i, j] = (-dhdx + fu[j]*v_at_u + nu*(d2x + d2y)
+                               - ududx - vdudy - wu[j]*u)
+
+            # the v equation
+            if i < nx:
+                v = _v[i+1, j+1]
+                dhdy = (_phi[i+1, j+1] - _phi[i+1, j]) / dy
+                u_at_v = 0.25*(_u[i+1, j] + _u[i+1, j+1] + _u[i+2, j] + _u[i+2, j+1])
+                d2x = (_v[i, j+1] - 2.0*v + _v[i+2, j+1]) * rdx2
+                d2y = (_v[i+1, j] - 2.0*v + _v[i+1, j+2]) * rdy2
+                vbarw = 0.5*(_v[i, j+1] + v)
+                vbare = 0.5*(v + _v[i+2, j+1])
+                udvdx = u_at_v*(vbare - vbarw) / dx
+                vbars = 0.5*(_v[i+1, j] + v)
+                vbarn = 0.5*(v + _v[i+1, j+2])
+                vdvdy = 0.5*(vbarn**2 - vbars**2) / dy
+                v_rhs[i, j] = (-dhdy - fv[j]*u_at_v + nu*(d2x + d2y)
+                               - udvdx - vdvdy - wv[j]*v)
+
+
+@_jit
+def linear_tendency(_u, _v, _h, fu, fv, g, H, nu, nu_phi, wu, wv, dx, dy, u_rhs, v_rhs, h_rhs):
+    """Linear shallow water tendencies, see `LinearShallowWater._dynamics_terms`.
+    The sponge damping of h uses the u latitude rates `wu`."""
+    nx, ny = h_rhs.shape
+    rdx2 = 1.0 / dx**2
+    rdy2 = 1.0 / dy**2
+
+    for i in range(nx+1):
+        for j in range(ny+1):
+            # the height equation
+            if i < nx and j < ny:
+                h = _h[i+1, j+1]
+                div = (_u[i+2, j+1] - _u[i+1, j+1])/dx + (_v[i+1, j+2] - _v[i+1, j+1])/dy
+                d2x = (_h[i, j+1] - 2.0*h + _h[i+2, j+1]) * rdx2
+                d2y = (_h[i+1, j] - 2.0*h + _h[i+1, j+2]) * rdy2
+                h_rhs[i, j] = -H*div + nu_phi*(d2x + d2y) - wu[j]*h
+
+            # the u equation
+            if j < ny:
+                u = _u[i+1, j+1]
+                dhdx = (_h[i+1, j+1] - _h[i, j+1]) / dx
+                v_at_u = 0.25*(_v[i, j+1] + _v[i, j+2] + _v[i+1, j+1] + _v[i+1, j+2])
+                d2x = (_u[i, j+1] - 2.0*u + _u[i+2, j+1]) * rdx2
+                d2y = (_u[i+1, j] - 2.0*u + _u[i+1, j+2]) * rdy2
+                u_rhs[i, j] = fu[j]*v_at_u - g*dhdx + nu*(d2x + d2y) - wu[j]*u
+
+            # the v equation
+            if i < nx:
+                v = _v[i+1, j+1]
+                dhdy = (_h[i+1, j+1] - _h[i+1, j]) / dy
+                u_at_v = 0.25*(_u[i+1, j] + _u[i+1, j+1] + _u[i+2, j] + _u[i+2, j+1])
+                d2x = (_v[i, j+1] - 2.0*v + _v[i+2, j+1]) * rdx2
+                d2y = (_v[i+1, j] - 2.0*v + _v[i+1, j+2]) * rdy2
+                v_rhs[i, j] = -fv[j]*u_at_v - g*dhdy + nu*(d2x + d2y) - wv[j]*v
+
+
+@_jit
+def combine2(out, a, x, b, y):
+    """out = a*x + b*y for 1D arrays, in a single pass."""
+    for i in range(out.size):
+        out[i] = a*x[i] + b*y[i]
+
+
+@_jit
+def combine3(out, a, x, b, y, c, z):
+    """out = a*x + b*y + c*z for 1D arrays, in a single pass."""
+    for i in range(out.size):
+        out[i] = a*x[i] + b*y[i] + c*z[i]
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Semi-implicit timestepping of the gravity waves in the ShallowWater models.
+
+The gravity wave and Coriolis terms of the equations
+
+    ∂/∂t[u] = - g ∂/∂x[h] + fv + Nu
+    ∂/∂t[v] = - g ∂/∂y[h] - fu + Nv
+    ∂/∂t[h] = - H(∂/∂x[u] + ∂/∂y[v]) + Nh
+
+are integrated with the θ-scheme, while the remaining terms N (advection,
+dissipation and forcing) are stepped explicitly with AB3.  Eliminating u
+and v at the new time from the gravity wave terms alone gives a Helmholtz
+equation for h
+
+    (1 - θ²gHdt² ∆) h' = h* - θHdt ∇.u*
+
+where the starred fields are the explicit update of the fields.  The
+Laplacian ∆ = ∇.∇ is the one formed by the C-grid divergence and gradient
+operators, so the scheme conserves mass exactly.  For the nonlinear model,
+phi is the geopotential: g = 1 and H is the reference geopotential `phi0`.
+
+The Coriolis terms can't be left in AB3: the implicit step turns the fast
+gravity waves through a large angle each step, and the Adams-Bashforth
+extrapolation of their Coriolis tendency is then unstable at a timestep
+well inside the AB3 limit of 0.723/max|f|.  They are integrated with the
+same θ-scheme as the gravity waves
+
+  * in a periodic domain exactly, as a Fourier transform in x leaves a
+    block tridiagonal system in y for each wavenumber, see `PeriodicImplicitSolver`
+  * between walls by iterating the Coriolis terms around the Helmholtz
+    solve, see `SemiImplicit._solve_walled`
+
+As only the explicit terms limit the timestep, it can be several times
+longer than the gravity wave CFL of the explicit models allows, up to the
+limits of the explicit terms: `stable_dt()` of the dissipation and forcing.
+The default θ = 0.5 is second order and neutral for the gravity and inertial
+waves.  Larger θ damps them, at the cost of first order accuracy.
+
+    atmos = SemiImplicitPeriodicLinearShallowWater(nx, ny, Lx, Ly, g=g, H=H, dt=5000.0)
+"""
+
+import warnings
+
+import numpy as np
+
+from arakawac import PeriodicBoundaries, WallBoundaries
+from shallowwater import ShallowWater, LinearShallowWater
+
+
+class HelmholtzSolver(object):
+    """Solve (1 - a∆) h = rhs on the cell centres of an ArakawaCGrid.
+
+    h has zero derivative at the y-boundaries.  In the x-direction h is either
+    periodic, when the equation is diagonalised by a Fourier transform, or has
+    zero derivative at walls, when the cosine transform is used.  Each
+    wavenumber leaves a tridiagonal system in y, which is solved by the
+    Thomas algorithm for all wavenumbers (and ensemble members) at once.
+
+    The factorisations are cached by the value of `a`, which only changes
+    with the timestep.  Only the most recent `cache_size` are kept, as an
+    adaptive timestep changes at every step.
+    """
+    cache_size = 8
+
+    def __init__(self, nx, ny, dx, dy, periodic=True):
+        self.nx, self.ny = nx, ny
+        self.dx, self.dy = dx, dy
+        self.periodic = periodic
+
+        # eigenvalues of the second difference in x for each wavenumber
+        if periodic:
+            k = np.arange(nx//2 + 1)
+            self._eigx = (2.0*np.cos(2*np.pi*k/nx) - 2.0) / dx**2
+        else:
+            # cosine transform as the Fourier transform of the even
+            # extension of h to a periodic domain of 2*nx points
+            k = np.arange(nx + 1)
+            self._eigx = (2.0*np.cos(np.pi*k/nx) - 2.0) / dx**2
+        self._factors = {}
+
+    def _transform(self, rhs):
+        if self.periodic:
+            return np.fft.rfft(rhs, axis=-2)
+        return np.fft.rfft(np.concatenate([rhs, rhs[..., ::-1, :]], axis=-2), axis=-2)
+
+    def _inverse(self, rhs_k):
+        if self.periodic:
+            return np.fft.irfft(rhs_k, n=self.nx, axis=-2)
+        return np.fft.irfft(rhs_k, n=2*self.nx, axis=-2)[..., :self.nx, :]
+
+    def _factorise(self, a):
+        """The Thomas algorithm coefficients of the tridiagonal systems in y."""
+        key = np.asarray(a).tobytes()
+        factors = self._factors.get(key)
+        if factors is not None:
+            return factors
+
+        ny = self.ny
+        a = np.asarray(a)[..., np.newaxis, np.newaxis]
+        off = -a / self.dy**2                                       # (..., 1, 1)
+        diag = 1.0 - a*self._eigx[:, np.newaxis] - 2*off
+        diag = diag * np.ones(ny)                                   # (..., nk, ny)
+        # zero derivative at the boundaries
+        diag[..., 0] += off[..., 0]
+        diag[..., -1] += off[..., 0]
+
+        # forward elimination: denominators and modified upper diagonal
+        rdenom = np.empty_like(diag)
+        cprime = np.empty_like(diag)
+        rdenom[..., 0] = 1.0 / diag[..., 0]
+        cprime[..., 0] = off[..., 0] * rdenom[..., 0]
+        for j in range(1, ny):
+            rdenom[..., j] = 1.0 / (diag[..., j] - off[..., 0]*cprime[..., j-1])
+            cprime[..., j] = off[..., 0] * rdenom[..., j]
+
+        if len(self._factors) >= self.cache_size:
+            del self._factors[next(iter(self._factors))]
+        factors = self._factors[key] = (off[..., 0], rdenom, cprime)
+        return factors
+
+    def solve(self, rhs, a):
+        """Solve for h.  `rhs` has shape (..., nx, ny), `a` is a scalar or
+        broadcasts against the leading dimensions of rhs like (n_members, 1, 1)."""
+        a = np.asarray(a, dtype=float)
+        if a.ndim == 3:
+            a = a[:, 0, 0]
+        off, rdenom, cprime = self._factorise(a)
+
+        r = self._transform(rhs)
+        # Thomas algorithm in y, vectorised over the wavenumbers
+        r[..., 0] *= rdenom[..., 0]
+        for j in range(1, self.ny):
+            r[..., j] -= off*r[..., j-1]
+            r[..., j] *= rdenom[..., j]
+        for j in range(self.ny-2, -1, -1):
+            r[..., j] -= cprime[..., j]*r[..., j+1]
+        return self._inverse(r)
+
+
+class PeriodicImplicitSolver(object):
+    """Solve the implicit gravity wave and Coriolis terms of the θ-scheme
+
+        u' - a f v' + a g ∂/∂x[h'] = u*
+        v' + a f u' + a g ∂/∂y[h'] = v*
+        h' + a H (∂/∂x[u'] + ∂/∂y[v']) = h*
+
+    on an ArakawaCGrid that is periodic in x, with a = θdt and the C-grid
+    operators and averages of the explicit model.  A Fourier transform in x
+    leaves, for each wavenumber, a block tridiagonal system in y with a
+    block (v[j], u[j], h[j]) for each latitude, which is solved by block
+    LU decomposition for all wavenumbers (and ensemble members) at once.
+
+    The factorisations are cached by the parameters, see `HelmholtzSolver`.
+    """
+    cache_size = 8
+
+    def __init__(self, nx, ny, dx, dy):
+        self.nx, self.ny = nx, ny
+        self.dx, self.dy = dx, dy
+        # the phase of a shift by one point in x of each wavenumber
+        self._shift = np.exp(-2j*np.pi*np.arange(nx//2 + 1)/nx)[:, np.newaxis]
+        self._factors = {}
+
+    def _factorise(self, a, g, H, fu, fv):
+        params = [np.asarray(p, dtype=float) for p in (a, g, H, fu, fv)]
+        key = b''.join(p.tobytes() + str(p.shape).encode() for p in params)
+        factors = self._factors.get(key)
+        if factors is not None:
+            return factors
+
+        a, g, H, fu, fv = params
+        ny, dx, dy = self.ny, self.dx, self.dy
+        nb = ny + 1             # the last block only holds v[ny]
+        e = self._shift
+        xu = 0.5*(1 + e)        # x average of v at u points
+        xv = 0.5*(1 + e.conj()) # x average of u at v points
+        dxu = (1 - e)/dx        # x derivative of h at u points
+        dxh = (e.conj() - 1)/dx # x derivative of u at h points
+
+        j = np.arange(nb)
+        inner = j < ny          # blocks with u and h
+        lower = (j >= 1) & inner
+        # f at the u latitudes of each block, zero in the last
+        fu = np.concatenate([fu, np.zeros(fu.shape[:-1] + (1,))], axis=-1)
+        # the halos of u and h in y repeat the edge values
+        edge = np.where(j == 0, 2.0, 1.0)*inner
+        last = np.where(j == ny, 2.0, 1.0)*(j >= 1)
+
+        shape = np.broadcast(a, g, H, fu, fv, e).shape + (3, 3)
+        D = np.zeros(shape, dtype=complex)      # the diagonal blocks
+        A = np.zeros(shape, dtype=complex)      # coupling to block j-1
+        C = np.zeros(shape, dtype=complex)      # coupling to block j+1
+        V, U, P = 0, 1, 2
+        # the unused u and h of the last block are left as identity rows
+        D[..., V, V] = D[..., U, U] = D[..., P, P] = 1.0
+        D[..., V, U] = 0.5*a*fv*xv*edge
+        D[..., V, P] = a*g/dy*lower
+        D[..., U, V] = -0.5*a*fu*xu
+        D[..., U, P] = a*g*dxu*inner
+        D[..., P, V] = -a*H/dy*inner
+        D[..., P, U] = a*H*dxh*inner
+        A[..., V, U] = 0.5*a*fv*xv*last
+        A[..., V, P] = -a*g/dy*lower
+        C[..., U, V] = -0.5*a*fu*xu
+        C[..., P, V] = a*H/dy*inner
+
+        # block LU: the inverses of the pivot blocks, and the upper blocks
+        # multiplied by them
+        rpivot = np.empty_like(D)
+        cprime = np.zeros_like(C)
+        rpivot[..., 0, :, :] = np.linalg.inv(D[..., 0, :, :])
+        for i in range(1, nb):
+            cprime[..., i-1, :, :] = rpivot[..., i-1, :, :] @ C[..., i-1, :, :]
+            rpivot[..., i, :, :] = np.linalg.inv(D[..., i, :, :] - A[..., i, :, :] @ cprime[..., i-1, :, :])
+
+        # only v[j] is coupled to the block below, and only to v[j+1] of
+        # the block above, so the substitutions only need a column of the
+        # lower and upper blocks multiplied by the pivots.  The factors are
+        # stored with the block and component axes first, so each step of
+        # the substitutions works on contiguous arrays
+        lower_u = rpivot[..., V] * A[..., V, U, np.newaxis]
+        lower_h = rpivot[..., V] * A[..., V, P, np.newaxis]
+        upper_v = cprime[..., V]
+        blocks_first = lambda f: np.ascontiguousarray(np.moveaxis(f, (-2, -1), (0, 1)))
+        rpivot = np.ascontiguousarray(np.moveaxis(rpivot, (-3, -2, -1), (0, 1, 2)))
+        lower_u, lower_h, upper_v = blocks_first(lower_u), blocks_first(lower_h), blocks_first(upper_v)
+
+        if len(self._factors) >= self.cache_size:
+            del self._factors[next(iter(self._factors))]
+        factors = self._factors[key] = (rpivot, lower_u, lower_h, upper_v)
+        return factors
+
+    def solve(self, u, v, h, a, g, H, fu, fv):
+        """The new u, v and h from the explicit updates `u`, `v` and `h`.
+        `u` has shape (..., nx+1, ny), of which u[..., nx, :] repeats u[..., 0, :].
+        `fu` and `fv` are f at the latitudes of u and v, the parameters are
+        scalars or broadcast against the leading dimensions like (n_members, 1, 1)."""
+        nx, ny = self.nx, self.ny
+        rpivot, lower_u, lower_h, upper_v = self._factorise(a, g, H, fu, fv)
+
+        # the transformed fields, with the block and component axes first
+        nk = nx//2 + 1
+        rhs = np.zeros((ny + 1, 3) + u.shape[:-2] + (nk,), dtype=complex)
+        rhs[:, 0] = np.moveaxis(np.fft.rfft(v, axis=-2), -1, 0)
+        rhs[:ny, 1] = np.moveaxis(np.fft.rfft(u[..., :nx, :], axis=-2), -1, 0)
+        rhs[:ny, 2] = np.moveaxis(np.fft.rfft(h, axis=-2), -1, 0)
+
+        # forward and back substitution of the blocks in y
+        x = np.einsum('jab...,jb...->ja...', rpivot, rhs)
+        for j in range(1, ny + 1):
+            x[j] -= lower_u[j]*x[j-1, 1]
+            x[j] -= lower_h[j]*x[j-1, 2]
+        for j in range(ny - 1, -1, -1):
+            x[j] -= upper_v[j]*x[j+1, 0]
+
+        v = np.fft.irfft(np.moveaxis(x[:, 0], 0, -1), n=nx, axis=-2)
+        u = np.fft.irfft(np.moveaxis(x[:ny, 1], 0, -1), n=nx, axis=-2)
+        u = np.concatenate([u, u[..., :1, :]], axis=-2)
+        h = np.fft.irfft(np.moveaxis(x[:ny, 2], 0, -1), n=nx, axis=-2)
+        return u, v, h
+
+
+class SemiImplicit(object):
+    """Step the gravity waves and Coriolis terms of a ShallowWater model
+    semi-implicitly.  This is a mixin for the ShallowWater models, see the
+    concrete classes below.
+
+    `theta` is the implicitness of the gravity wave and Coriolis terms:
+    0.5 is the Crank-Nicolson scheme, larger values damp the gravity waves.
+    The timestep is limited by the explicit terms alone, see `stable_dt()`.
+    `phi0` is the reference geopotential of the nonlinear model; by default
+    the mean geopotential at the first step.  Between walls, the Coriolis
+    terms are iterated until the velocity changes by less than
+    `coriolis_tol` of its increment over the step, at most
+    `coriolis_iterations` times; a RuntimeWarning is issued if they have
+    not converged by then.
+    """
+    coriolis_tol = 1.0e-6
+    coriolis_iterations = 50
+
+    def __init__(self, *args, **kwargs):
+        self.theta = kwargs.pop('theta', 0.5)
+        self.phi0 = kwargs.pop('phi0', None)
+        super(SemiImplicit, self).__init__(*args, **kwargs)
+        if not isinstance(self, (PeriodicBoundaries, WallBoundaries)):
+            raise TypeError('SemiImplicit models need PeriodicBoundaries or WallBoundaries')
+        self.helmholtz = HelmholtzSolver(self.nx, self.ny, self.dx, self.dy,
+                                periodic=isinstance(self, PeriodicBoundaries))
+        self.implicit_solver = None
+        if self.helmholtz.periodic:
+            self.implicit_solver = PeriodicImplicitSolver(self.nx, self.ny, self.dx, self.dy)
+
+    def _gravity_parameters(self):
+        """g and H of the gravity wave terms."""
+        if isinstance(self, LinearShallowWater):
+            return self.g, self.H
+        if self.phi0 is None:
+            self.phi0 = self.phi.mean(axis=(-2, -1), keepdims=self.n_members is not None)
+        return 1.0, self.phi0
+
+    def _coriolis_parameters(self):
+        """f at the latitudes of u and v."""
+        return self.f0 + self.beta*self.uy, self.f0 + self.beta*self.vy
+
+    def max_coriolis(self):
+        """The largest |f| on the grid."""
+        return np.abs(self._coriolis_parameters()[1]).max()
+
+    def _gravity_terms(self, _phi, u, v, g, H):
+        """The gravity wave tendencies of u, v and phi.
+        `_phi` includes the halo, `u` and `v` don't."""
+        du = self.diffx(_phi[..., 1:-1])        # (nx+1, ny)
+        du *= -g
+        dv = self.diffy(_phi[..., 1:-1, :])     # (nx, ny+1)
+        dv *= -g
+        dphi = self.diffx(u)                    # (nx, ny)
+        dphi += self.diffy(v)
+        dphi *= -H
+        return du, dv, dphi
+
+    def _coriolis_terms(self, u, v):
+        """The Coriolis tendencies fv of u and -fu of v, with the averages
+        of the explicit model.  `u` and `v` don't include the halo."""
+        fu, fv = self._coriolis_parameters()
+        pad = [(0, 0)]*(u.ndim - 2)
+        xmode = 'wrap' if self.helmholtz.periodic else 'edge'
+        v_at_u = self.centre_average(np.pad(v, pad + [(1, 1), (0, 0)], mode=xmode))   # (nx+1, ny)
+        u_at_v = self.centre_average(np.pad(u, pad + [(0, 0), (1, 1)], mode='edge'))  # (nx, ny+1)
+        return fu*v_at_u, -fv*u_at_v
+
+    def _rhs(self):
+        # the explicit terms: the full tendency less the gravity wave
+        # and Coriolis terms, which are kept for the θ-scheme
+        dstate = super(SemiImplicit, self)._rhs()
+        g, H = self._gravity_parameters()
+        du, dv, dphi = self._gravity_terms(self._phi, self.u, self.v, g, H)
+        cu, cv = self._coriolis_terms(self.u, self.v)
+        du += cu
+        dv += cv
+        dstate[0] -= du
+        dstate[1] -= dv
+        dstate[2] -= dphi
+        self._implicit_tendency = du, dv, dphi
+        return dstate
+
+    def _pad(self, phi):
+        """phi with a halo set by the boundary conditions of the Helmholtz solver."""
+        pad = [(0, 0)]*(phi.ndim - 2)
+        xmode = 'wrap' if self.helmholtz.periodic else 'edge'
+        _phi = np.pad(phi, pad + [(1, 1), (0, 0)], mode=xmode)
+        return np.pad(_phi, pad + [(0, 0), (1, 1)], mode='edge')
+
+    def dstate(self):
+        # AB3 update of the explicit terms
+        dn = super(SemiImplicit, self).dstate()
+        g, H = self._gravity_parameters()
+        dt, theta = self.dt, self.theta
+
+        # explicit part of the implicit terms, weighted 1-θ
+        du, dv, dphi = self._implicit_tendency
+        ustar = self.u + dn[0] + (1-theta)*dt*du
+        vstar = self.v + dn[1] + (1-theta)*dt*dv
+        phistar = self.phi + dn[2] + (1-theta)*dt*dphi
+
+        # implicit part, weighted θ
+        if self.helmholtz.periodic:
+            fu, fv = self._coriolis_parameters()
+            u, v, phi = self.implicit_solver.solve(ustar, vstar, phistar, theta*dt, g, H, fu, fv)
+        else:
+            u, v, phi = self._solve_walled(ustar, vstar, phistar, g, H)
+
+        dstate = np.empty(3, dtype=object)
+        dstate[0], dstate[1], dstate[2] = u - self.u, v - self.v, phi - self.phi
+        return dstate
+
+    def _solve_walled(self, ustar, vstar, phistar, g, H):
+        """The implicit part of the step between walls.  The gravity wave
+        terms are solved by the Helmholtz equation, with the implicit Coriolis
+        terms of the previous iteration added to the explicit update.
+
+        Each iteration turns the error of the last by the Coriolis terms,
+        multiplying it by up to iθ|f|dt, so on its own it only converges for
+        θ|f|dt < 1.  Relaxing the iterations with the weight
+        w = 1/(1 + (θ|f|dt)^2) makes them converge for any timestep."""
+        a = self.theta*self.dt
+        w = 1.0 / (1.0 + (a*self.max_coriolis())**2)
+        # no flow through the walls
+        ustar[..., 0, :] = 0
+        ustar[..., -1, :] = 0
+
+        u, v, phi = self.u, self.v, self.phi
+        for _ in range(self.coriolis_iterations):
+            cu, cv = self._coriolis_terms(u, v)
+            uc = ustar + a*cu
+            uc[..., 0, :] = 0
+            uc[..., -1, :] = 0
+            vc = vstar + a*cv
+            rhs = phistar - a*H*(self.diffx(uc) + self.diffy(vc))
+            phinew = self.helmholtz.solve(rhs, a*a*g*H)
+            du, dv, _ = self._gravity_terms(self._pad(phinew), uc, vc, g, H)
+            du = w*(uc + a*du - u)
+            dv = w*(vc + a*dv - v)
+            u, v, phi = u + du, v + dv, phi + w*(phinew - phi)
+            # converged when the iteration is small against the increment of the step
+            change = max(np.abs(du).max(), np.abs(dv).max())
+            scale = max(np.abs(u - self.u).max(), np.abs(v - self.v).max())
+            if change <= self.coriolis_tol*scale:
+                break
+        else:
+            warnings.warn('The implicit Coriolis terms did not converge in %d iterations at t=%g: '
+                          'the last changed the velocity by %.3g of its increment'
+                          % (self.coriolis_iterations, self.t, change/scale if scale else np.inf),
+                          RuntimeWarning)
+        return u, v, phi
+
+
+class SemiImplicitPeriodicShallowWater(SemiImplicit, PeriodicBoundaries, ShallowWater): pass
+class SemiImplicitWalledShallowWater(SemiImplicit, WallBoundaries, ShallowWater): pass
+class SemiImplicitPeriodicLinearShallowWater(SemiImplicit, PeriodicBoundaries, LinearShallowWater): pass
+class SemiImplicitWalledLinearShallowWater(SemiImplicit, WallBoundaries, LinearShallowWater): pass
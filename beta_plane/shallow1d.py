@@ -1,11 +1,11 @@
 
 import numpy as np
 
-from arakawac import Arakawa1D
-from timesteppers import adamsbashforthgen
+from arakawac import Arakawa1D, _object_array
+from timesteppers import AdamsBashforth3
 
 
-class ShallowWater1D(Arakawa1D):
+class ShallowWater1D(Arakawa1D, AdamsBashforth3):
     """The Shallow Water Equations on the Arakawa-C grid."""
     def __init__(self, nx, Lx=1.0e7, nu=1.0e3, nu_phi=None, r=1.0e-5, dt=1000.0):
         super(ShallowWater1D, self).__init__(nx, Lx)
@@ -17,10 +17,6 @@ class ShallowWater1D(Arakawa1D):
 
         # timestepping
         self.dt = dt
-        self.tc = 0  # number of timesteps taken
-        self.t = 0.0
-
-        self._stepper = adamsbashforthgen(self._rhs, self.dt)
 
         self._forcings = []
         self._tracers  = {}
@@ -65,7 +61,7 @@ class ShallowWater1D(Arakawa1D):
         u_rhs += self.nu*self.diff2x(self._u)
         #u_rhs += - ududx                     # nonlin u advection terms
 
-        dstate = np.array([u_rhs, phi_rhs])
+        dstate = _object_array(u_rhs, phi_rhs)
         return dstate
 
     def _rhs(self):
@@ -75,14 +71,9 @@ class ShallowWater1D(Arakawa1D):
         return self._dynamics_terms() + self.rhs() + dstate
 
     def step(self):
-        dt, tc = self.dt, self.tc
-
-        self._apply_boundary_conditions()
-        newstate = self.state + next(self._stepper)
-        self.state = newstate
-
-        self.t  += dt
-        self.tc += 1
+        self.apply_boundary_conditions()
+        self._add_to_state(self._step_increment())
+        self._incr_timestep()
 
 if __name__ == '__main__':
     H = 2.
@@ -114,7 +105,7 @@ if __name__ == '__main__':
         du = -sw.u*1e-3
         ss = phi_eq(sw.t)
         dphi[:] = (ss - sw.phi) / 100.
-        return np.array([du, dphi])
+        return _object_array(du, dphi)
 
     ts = []
     es = []
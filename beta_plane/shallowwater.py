@@ -21,31 +21,61 @@ import numpy as np
 
 from arakawac import ArakawaCGrid, PeriodicBoundaries, WallBoundaries
 from timesteppers import AdamsBashforth3
+import kernels
+
+
+def _grow(shape, di, dj):
+    """`shape` with `di` more longitudes and `dj` more latitudes."""
+    return shape[:-2] + (shape[-2]+di, shape[-1]+dj)
+
+
+def _member(value, k, ndim):
+    """The value of a parameter for ensemble member `k`, with `ndim`
+    dimensions: 0 for a scalar, 1 for a profile in latitude."""
+    value = np.asarray(value)
+    if value.ndim == 3:
+        value = value[k, 0]     # per-member value (n_members, 1, 1 or ny)
+    return value.reshape(value.shape[-1:] if ndim else ())[()]
 
 
 class ShallowWater(ArakawaCGrid, AdamsBashforth3):
     """The Shallow Water Equations on the Arakawa-C grid."""
     def __init__(self, nx, ny, Lx=1.0e7, Ly=1.0e7, f0=0.0,
                     beta=0.0, nu=1.0e3, nu_phi=None,
-                    r=1.0e-5, dt=1000.0):
-        super(ShallowWater, self).__init__(nx, ny, Lx, Ly)
+                    r=1.0e-5, dt=1000.0, workspace=False, backend='numpy',
+                    n_members=None):
+        super(ShallowWater, self).__init__(nx, ny, Lx, Ly, workspace, n_members)
+
+        # `backend` selects how the dynamics are calculated:
+        # - 'numpy': whole-array operations on the grid (the reference implementation)
+        # - 'numba': fused compiled loops from `kernels.py`
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("Unknown backend '%s', use 'numpy' or 'numba'" % backend)
+        if backend == 'numba' and not kernels.NUMBA:
+            print("WARNING: numba not available.  Falling back to numpy")
+            backend = 'numpy'
+        self.backend = backend
 
         # Coriolis terms
-        self.f0 = f0
-        self.beta = beta
+        # in an ensemble, the parameters can be given per member as sequences
+        # of length n_members.  They are stored with shape (n_members, 1, 1)
+        self.f0 = self._member_param(f0)
+        self.beta = self._member_param(beta)
 
         # dissipation and friction
-        self.nu = nu                                    # u, v dissipation
-        self.nu_phi = nu if nu_phi is None else nu_phi  # phi dissipation
-        self.r = r      # rayleigh damping at edges
+        self.nu = self._member_param(nu)                # u, v dissipation
+        self.nu_phi = self.nu if nu_phi is None else self._member_param(nu_phi)  # phi dissipation
+        self.r = self._member_param(r)      # rayleigh damping at edges
         self.sponge_ny = ny//7
         self.sponge = np.exp(-np.linspace(0, 5, self.sponge_ny))
+        self._sponge_profiles = {}
 
         # timestepping
         self.dt = dt
 
         self.forcings = []
         self.tracers  = {}
+        self._tracer_stack = TracerStack(self)
 
     def add_forcing(self, fn):
         """Add a forcing term to the model.  Typically used as a decorator:
@@ -64,13 +94,31 @@ class ShallowWater(ArakawaCGrid, AdamsBashforth3):
         self.forcings.append(fn)
         return fn
 
-    def damping(self, var):
+    def damping(self, var, out=None):
         # sponges are active at the top and bottom of the domain by applying Rayleigh friction
         # with exponential decay towards the centre of the domain
-        var_sponge = np.zeros_like(var)
-        var_sponge[:, :self.sponge_ny] = self.sponge[np.newaxis, :]
-        var_sponge[:, -self.sponge_ny:] = self.sponge[::-1][np.newaxis, :]
-        return self.r*var_sponge*var
+        profile = self._sponge_profile(var.shape[-1])
+        r_sponge = np.multiply(self.r, profile,
+                        out=self._work('r_sponge', np.broadcast(self.r, profile).shape))
+        return np.multiply(r_sponge, var, out=out)
+
+    def _sponge_profile(self, ny):
+        """The sponge weights at each of `ny` latitudes of a variable, i.e.
+        ny for u and phi, ny+1 for v.  Profiles are cached by size."""
+        profile = self._sponge_profiles.get(ny)
+        if profile is None:
+            profile = np.zeros(ny)
+            profile[:self.sponge_ny] = self.sponge
+            profile[-self.sponge_ny:] = self.sponge[::-1]
+            self._sponge_profiles[ny] = profile
+        return profile
+
+    def max_wave_speed(self, state=None):
+        """An upper bound of the speed of the flow plus gravity waves,
+        for the Courant number of adaptive timestepping."""
+        u, v, phi = self.state if state is None else state
+        flow = max(np.abs(u).max(), np.abs(v).max())
+        return flow + np.sqrt(max(phi.max(), 0.0))
 
     def rhs(self):
         """Set a right-hand side term for the equation.
@@ -79,52 +127,119 @@ class ShallowWater(ArakawaCGrid, AdamsBashforth3):
         return zeros
 
     def _dynamics_terms(self):
-        """Calculate the dynamics for the u, v and phi equations."""
+        """Calculate the dynamics for the u, v and phi equations.
+
+        The terms are evaluated in place into the arrays returned by
+        `_tendency()`.  With `workspace=True` all intermediate arrays
+        are taken from the grid workspace, so no new field-sized arrays
+        are allocated once the first call has been made."""
+        if self.backend == 'numba':
+            return self._dynamics_terms_numba()
+
+        work = self._work
+        dstate = self._tendency()
+        u_rhs, v_rhs, phi_rhs = dstate
+        us, vs, phis = self.u.shape, self.v.shape, self.phi.shape
+
         # ~~~ Nonlinear Dynamics ~~~
-        u_at_v, v_at_u = self.uvatuv()              # (nx, ny+1), (nx+1, ny)
-        ubarx = self.x_average(self._u)[:, 1:-1]    # u averaged to v lons
-        ubary = self.y_average(self._u)[1:-1, :]    # u averaged to v lats
+        # using centre_average(psi)[1:-1, :] == centre_average(psi[1:-1, :]) etc.
+        # to only calculate the values that are needed
+        u_at_v = self.centre_average(self._u[..., 1:-1, :], out=work('u_at_v', vs))   # (nx, ny+1)
+        v_at_u = self.centre_average(self._v[..., 1:-1], out=work('v_at_u', us))      # (nx+1, ny)
+        ubarx = self.x_average(self._u[..., 1:-1], out=work('ubarx', _grow(us, 1, 0)))      # u averaged to v lons
+        ubary = self.y_average(self._u[..., 1:-1, :], out=work('ubary', _grow(us, 0, 1)))   # u averaged to v lats
 
-        vbary = self.y_average(self._v)[1:-1, :]
-        vbarx = self.x_average(self._v)[:, 1:-1]
+        vbary = self.y_average(self._v[..., 1:-1, :], out=work('vbary', _grow(vs, 0, 1)))
+        vbarx = self.x_average(self._v[..., 1:-1], out=work('vbarx', _grow(vs, 1, 0)))
 
         # the height equation
-        phi_at_u = self.x_average(self._phi)[:, 1:-1]  # (nx+1, ny)
-        phi_at_v = self.y_average(self._phi)[1:-1, :]  # (nx, ny+1)
-
-        phi_rhs  = - self.diffx(phi_at_u * self.u) - self.diffy(phi_at_v * self.v)  # (nx, ny)
-        phi_rhs += self.nu_phi*self.del2(self._phi)       # diffusion
+        # phi_rhs = - ∂/∂x[phi u] - ∂/∂y[phi v] + nu_phi ∆phi
+        uflux = self.x_average(self._phi[..., 1:-1], out=work('uflux', us))    # phi at u (nx+1, ny)
+        uflux *= self.u
+        vflux = self.y_average(self._phi[..., 1:-1, :], out=work('vflux', vs)) # phi at v (nx, ny+1)
+        vflux *= self.v
+
+        self.diffx(uflux, out=phi_rhs)                              # (nx, ny)
+        np.negative(phi_rhs, out=phi_rhs)
+        phi_rhs -= self.diffy(vflux, out=work('tmp', phis))
+        tmp = self.del2(self._phi, out=work('tmp', phis))           # diffusion
+        tmp *= self.nu_phi
+        phi_rhs += tmp
         #phi_rhs -= self.damping(self.phi)               # damping at top and bottom boundaries
 
         # the u equation
-        dhdx = self.diffx(self._phi)[:, 1:-1]       # (nx+2, ny)
-        ududx = 0.5*self.diffx(ubarx**2)            # u*du/dx at u points
-        vdudy = v_at_u*self.diffy(ubary)            # v*du/dy at u points
-
-        u_rhs  = -dhdx + (self.f0 + self.beta*self.uy)*v_at_u
-        u_rhs += self.nu*self.del2(self._u)
-        u_rhs += - ududx - vdudy               # nonlin u advection terms
-        u_rhs -= self.damping(self.u)
+        # u_rhs = -∂/∂x[phi] + fv - u ∂/∂x[u] - v ∂/∂y[u] + nu ∆u - damping
+        self.diffx(self._phi[..., 1:-1], out=u_rhs)                   # dhdx (nx+1, ny)
+        np.negative(u_rhs, out=u_rhs)
+        f = np.multiply(self.beta, self.uy, out=work('beta_uy', np.broadcast(self.beta, self.uy).shape))
+        f = np.add(f, self.f0, out=work('f_u', np.broadcast(f, self.f0).shape))
+        tmp = np.multiply(f, v_at_u, out=work('tmp', us))
+        u_rhs += tmp
+        tmp = self.del2(self._u, out=tmp)
+        tmp *= self.nu
+        u_rhs += tmp
+
+        np.square(ubarx, out=ubarx)
+        ududx = self.diffx(ubarx, out=work('tmp', us))              # u*du/dx at u points
+        ududx *= 0.5
+        vdudy = self.diffy(ubary, out=work('tmp2', us))             # v*du/dy at u points
+        vdudy *= v_at_u
+        np.negative(ududx, out=ududx)
+        ududx -= vdudy
+        u_rhs += ududx                                              # nonlin u advection terms
+        u_rhs -= self.damping(self.u, out=work('tmp', us))
 
         # the v equation
-        dhdy  = self.diffy(self._phi)[1:-1, :]
-        udvdx = u_at_v*self.diffx(vbarx)
-        vdvdy = 0.5*self.diffy(vbary**2)            # v*dv/dy at v points
+        # v_rhs = -∂/∂y[phi] - fu - u ∂/∂x[v] - v ∂/∂y[v] + nu ∆v - damping
+        self.diffy(self._phi[..., 1:-1, :], out=v_rhs)                   # dhdy (nx, ny+1)
+        np.negative(v_rhs, out=v_rhs)
+        f = np.multiply(self.beta, self.vy, out=work('beta_vy', np.broadcast(self.beta, self.vy).shape))
+        f = np.add(f, self.f0, out=work('f_v', np.broadcast(f, self.f0).shape))
+        v_rhs -= np.multiply(f, u_at_v, out=work('tmp', vs))
+        tmp = self.del2(self._v, out=work('tmp', vs))
+        tmp *= self.nu
+        v_rhs += tmp
+
+        udvdx = self.diffx(vbarx, out=work('tmp', vs))              # u*dv/dx at v points
+        udvdx *= u_at_v
+        np.square(vbary, out=vbary)
+        vdvdy = self.diffy(vbary, out=work('tmp2', vs))             # v*dv/dy at v points
+        vdvdy *= 0.5
+        np.negative(udvdx, out=udvdx)
+        udvdx -= vdvdy
+        v_rhs += udvdx
+        v_rhs -= self.damping(self.v, out=work('tmp', vs))
 
-        v_rhs  = -dhdy -(self.f0 + self.beta*self.vy)*u_at_v
-        v_rhs += self.nu*self.del2(self._v)
-        v_rhs += - udvdx - vdvdy
-        v_rhs -= self.damping(self.v)
-
-        dstate = np.array([u_rhs, v_rhs, phi_rhs])
+        return dstate
 
+    def _dynamics_terms_numba(self):
+        dstate = self._tendency()
+        u_rhs, v_rhs, phi_rhs = dstate
+        fu, fv = self.f0 + self.beta*self.uy[0], self.f0 + self.beta*self.vy[0]
+        wu, wv = self.r*self._sponge_profile(self.ny), self.r*self._sponge_profile(self.ny+1)
+        # the kernels step one member of an ensemble at a time
+        for k in (range(self.n_members) if self.n_members else [()]):
+            kernels.nonlinear_tendency(self._u[k], self._v[k], self._phi[k],
+                _member(fu, k, 1), _member(fv, k, 1),
+                _member(self.nu, k, 0), _member(self.nu_phi, k, 0),
+                _member(wu, k, 1), _member(wv, k, 1),
+                self.dx, self.dy, u_rhs[k], v_rhs[k], phi_rhs[k])
         return dstate
 
     def _rhs(self):
-        dstate = np.zeros_like(self.state)
+        forcing = np.zeros_like(self.state)
         for f in self.forcings:
-            dstate += f(self)
-        return self._dynamics_terms() + self.rhs() + dstate
+            forcing += f(self)
+        # add the other terms in place to the dynamics, which can be
+        # written straight into the timestepper's history
+        dstate = self._dynamics_terms()
+        rhs = self.rhs()
+        if np.ndim(rhs) == 0:
+            rhs = [rhs]*len(dstate)
+        for field, r, force in zip(dstate, rhs, forcing):
+            field += r
+            field += force
+        return dstate
 
     def add_tracer(self, name, initial_state=0.0, rhs=0, kappa=0.0, damping=1.0):
         """Add a tracer to the shallow water model.
@@ -139,9 +254,14 @@ class ShallowWater(ArakawaCGrid, AdamsBashforth3):
         Once a tracer has been added to the model it's value can be accessed
         by the `tracer(name)` method.
         """
-        t = ShallowWaterTracer(name, grid=self, kappa=kappa,
-                            initial_state=initial_state, damping=damping)
-        self.tracers[name] = t
+        if name in self.tracers:
+            t = self.tracers[name]
+            t.kappa, t.damping = kappa, damping
+        else:
+            t = ShallowWaterTracer(name, self._tracer_stack)
+            self._tracer_stack.add(t, kappa, damping)
+            self.tracers[name] = t
+        t.state = initial_state
         return t
 
     def tracer(self, name):
@@ -149,38 +269,45 @@ class ShallowWater(ArakawaCGrid, AdamsBashforth3):
 
     # allow tracers to be called as properties of the object
     def __getattr__(self, name):
-        if name in self.tracers:
+        # only called when normal attribute lookup fails. Look in __dict__
+        # directly so that objects being copied or unpickled don't recurse
+        if name in self.__dict__.get('tracers', ()):
             return self.tracer(name)
+        raise AttributeError(name)
 
     def step(self):  # override the basic timestepping `step` to support tracers
-        dt, tc = self.dt, self.tc
-
+        tracers = self._tracer_stack
         self.apply_boundary_conditions()
-        for tracer in self.tracers.values():
-            tracer.apply_boundary_conditions()
+        if self.tracers:
+            tracers.apply_boundary_conditions()
 
-        newstate = self.state + self.dstate()
+        # with adaptive timestepping, dt is set here and the tracers follow it
+        dstate = self._step_increment()
 
-        # calculate all tracer dstates before updating any of them
-        dstates = [t.dstate() for t in self.tracers.values()]
-        for tracer, dstate in zip(self.tracers.values(), dstates):
-            tracer.state = tracer.state + dstate
-            tracer._incr_timestep()
+        # step the tracers before updating the flow that advects them
+        if self.tracers:
+            tracers._add_to_state(tracers.dstate())
+            tracers._incr_timestep()
 
-        self.state = newstate
+        self._add_to_state(dstate)
         self._incr_timestep()
 
 
 class LinearShallowWater(ShallowWater):
-    def __init__(self, nx, ny, Lx=1.0e7, Ly=1.0e7, f0=0.0, beta=0.0, g=9.8, H=10.0, nu=1.0e3, nu_phi=None, r=1.0e-5, dt=1000.0):
-        super(LinearShallowWater, self).__init__(nx, ny, Lx, Ly, f0, beta, nu, nu_phi, r, dt)
+    def __init__(self, nx, ny, Lx=1.0e7, Ly=1.0e7, f0=0.0, beta=0.0, g=9.8, H=10.0, nu=1.0e3, nu_phi=None, r=1.0e-5, dt=1000.0, workspace=False, backend='numpy', n_members=None):
+        super(LinearShallowWater, self).__init__(nx, ny, Lx, Ly, f0, beta, nu, nu_phi, r, dt, workspace, backend, n_members)
 
-        self.g = g
-        self.H = H
+        self.g = self._member_param(g)
+        self.H = self._member_param(H)
 
         self.hx = self.phix
         self.hy = self.phiy
 
+    def max_wave_speed(self, state=None):
+        u, v, h = self.state if state is None else state
+        flow = max(np.abs(u).max(), np.abs(v).max())
+        return flow + np.sqrt(np.max(self.g*self.H))
+
     # make h an proxy for phi
     @property
     def h(self):
@@ -191,54 +318,118 @@ class LinearShallowWater(ShallowWater):
         return self._phi
 
     def _dynamics_terms(self):
-        """Calculate the dynamics of the u, v and h equations."""
+        """Calculate the dynamics of the u, v and h equations.
+        See `ShallowWater._dynamics_terms` for the use of the workspace."""
+        if self.backend == 'numba':
+            return self._dynamics_terms_numba()
+
         # ~~~ Linear dynamics ~~~
         f0, beta, g, H, nu = self.f0, self.beta, self.g, self.H, self.nu
+        work = self._work
+        dstate = self._tendency()
+        u_rhs, v_rhs, h_rhs = dstate
+        us, vs, hs = self.u.shape, self.v.shape, self.h.shape
 
-        uu, vv = self.uvatuv()
+        uu = self.centre_average(self._u[..., 1:-1, :], out=work('u_at_v', vs))   # (nx, ny+1)
+        vv = self.centre_average(self._v[..., 1:-1], out=work('v_at_u', us))      # (nx+1, ny)
 
         # the height equation
-        h_rhs = -H*self.divergence() + self.nu_phi*self.del2(self._h) - self.damping(self.h)
+        # h_rhs = -H ∇.u + nu_phi ∆h - damping
+        self.diffx(self.u, out=h_rhs)
+        h_rhs += self.diffy(self.v, out=work('tmp', hs))
+        h_rhs *= -H
+        tmp = self.del2(self._h, out=work('tmp', hs))
+        tmp *= self.nu_phi
+        h_rhs += tmp
+        h_rhs -= self.damping(self.h, out=work('tmp', hs))
 
         # the u equation
-        dhdx = self.diffx(self._h)[:, 1:-1]
-        u_rhs = (f0 + beta*self.uy)*vv - g*dhdx + nu*self.del2(self._u) - self.damping(self.u)
+        # u_rhs = fv - g ∂/∂x[h] + nu ∆u - damping
+        f = np.multiply(beta, self.uy, out=work('beta_uy', np.broadcast(beta, self.uy).shape))
+        f = np.add(f, f0, out=work('f_u', np.broadcast(f, f0).shape))
+        np.multiply(f, vv, out=u_rhs)
+        dhdx = self.diffx(self._h[..., 1:-1], out=work('tmp', us))
+        dhdx *= g
+        u_rhs -= dhdx
+        tmp = self.del2(self._u, out=work('tmp', us))
+        tmp *= nu
+        u_rhs += tmp
+        u_rhs -= self.damping(self.u, out=work('tmp', us))
 
         # the v equation
-        dhdy  = self.diffy(self._h)[1:-1, :]
-        v_rhs = -(f0 + beta*self.vy)*uu - g*dhdy + nu*self.del2(self._v) - self.damping(self.v)
+        # v_rhs = -fu - g ∂/∂y[h] + nu ∆v - damping
+        f = np.multiply(beta, self.vy, out=work('beta_vy', np.broadcast(beta, self.vy).shape))
+        f = np.add(f, f0, out=work('f_v', np.broadcast(f, f0).shape))
+        np.multiply(f, uu, out=v_rhs)
+        np.negative(v_rhs, out=v_rhs)
+        dhdy = self.diffy(self._h[..., 1:-1, :], out=work('tmp', vs))
+        dhdy *= g
+        v_rhs -= dhdy
+        tmp = self.del2(self._v, out=work('tmp', vs))
+        tmp *= nu
+        v_rhs += tmp
+        v_rhs -= self.damping(self.v, out=work('tmp', vs))
 
-        dstate = np.array([u_rhs, v_rhs, h_rhs])
+        return dstate
 
+    def _dynamics_terms_numba(self):
+        dstate = self._tendency()
+        u_rhs, v_rhs, h_rhs = dstate
+        fu, fv = self.f0 + self.beta*self.uy[0], self.f0 + self.beta*self.vy[0]
+        wu, wv = self.r*self._sponge_profile(self.ny), self.r*self._sponge_profile(self.ny+1)
+        for k in (range(self.n_members) if self.n_members else [()]):
+            kernels.linear_tendency(self._u[k], self._v[k], self._h[k],
+                _member(fu, k, 1), _member(fv, k, 1),
+                _member(self.g, k, 0), _member(self.H, k, 0),
+                _member(self.nu, k, 0), _member(self.nu_phi, k, 0),
+                _member(wu, k, 1), _member(wv, k, 1),
+                self.dx, self.dy, u_rhs[k], v_rhs[k], h_rhs[k])
         return dstate
 
 
-class ShallowWaterTracer(AdamsBashforth3):
-    def __init__(self, name, grid, kappa=0.0, initial_state=0.0, damping=0.0):
-        self.name = name
+class TracerStack(AdamsBashforth3):
+    """The tracers of a ShallowWater model, stored on the cell centres as
+    one stacked array of shape (ntracers, nx+2, ny+2) so that they are
+    advected, diffused and stepped together.  Each tracer is accessed
+    through a `ShallowWaterTracer`, which is a view of its layer."""
+    def __init__(self, grid):
         self.grid = grid
+        self.tracers = []
+        self._state = np.zeros((0,) + grid._phi.shape)
+        # per-tracer coefficients, broadcast against the stack
+        self.kappa = np.zeros((0,) + (1,)*grid._phi.ndim)
+        self.damping = np.zeros_like(self.kappa)
 
-        self._state = np.zeros_like(grid._phi)  # store tracer on cell centres
-        self.state = initial_state
-
-        self.kappa = kappa # diffusion
-        self.damping = damping
-
-        self.dt = grid.dt
-
-        self.forcings = []
+    @property
+    def dt(self):
+        # tracers are stepped with the timestep of the grid
+        return self.grid.dt
 
     @property
     def state(self):
         # view without boundary conditions
-        return self._state[1:-1, 1:-1]
+        return self._state[..., 1:-1, 1:-1]
 
     @state.setter
     def state(self, value):
-        self._state[1:-1, 1:-1] = value
+        self._state[..., 1:-1, 1:-1] = value
+
+    def add(self, tracer, kappa, damping):
+        """Add a layer to the stack for `tracer` and return its index.
+        The timestepping history of the other tracers is kept, with a zero
+        tendency history for the new one."""
+        history = self.get_history()
+        layer = np.zeros((1,) + self._state.shape[1:])
+        self._state = np.concatenate([self._state, layer])
+        self.kappa = np.concatenate([self.kappa, np.full((1,) + self.kappa.shape[1:], kappa)])
+        self.damping = np.concatenate([self.damping, np.full((1,) + self.damping.shape[1:], damping)])
+        self.tracers.append(tracer)
+        self._increment = None
+        self.set_history([(dt, np.concatenate([f, np.zeros((1,) + f.shape[1:])])) for dt, f in history])
+        return len(self.tracers) - 1
 
     def _advection(self):
-        """Calculates the conservation of the advected tracer by the fluid flow.
+        """Calculates the conservation of the advected tracers by the fluid flow.
 
         ∂[q]/∂t + ∇ . (uq) = 0
 
@@ -247,19 +438,77 @@ class ShallowWaterTracer(AdamsBashforth3):
         grid = self.grid
         q = self._state
 
-        q_at_u = grid.x_average(q)[:, 1:-1]  # (nx+1, ny)
-        q_at_v = grid.y_average(q)[1:-1, :]  # (nx, ny+1)
+        q_at_u = grid.x_average(q)[..., 1:-1]     # (ntracers, nx+1, ny)
+        q_at_v = grid.y_average(q)[..., 1:-1, :]  # (ntracers, nx, ny+1)
 
-        return grid.diffx(q_at_u * grid.u) + grid.diffy(q_at_v * grid.v)  # (nx, ny)
+        return grid.diffx(q_at_u * grid.u) + grid.diffy(q_at_v * grid.v)  # (ntracers, nx, ny)
 
     def _diffusion(self):
         return self.kappa*self.grid.del2(self._state) + self.damping*self.grid.damping(self.state)
 
     def _rhs(self):
-        forcings = np.zeros_like(self.state)
-        for f in self.forcings:
-            forcings += f(self)
-        return self._diffusion() - self._advection() + self.rhs() + forcings
+        dstate = self._diffusion() - self._advection()
+        # the terms of individual tracers
+        for i, tracer in enumerate(self.tracers):
+            rhs = tracer.rhs()
+            if not (np.isscalar(rhs) and rhs == 0):
+                dstate[i] += rhs
+            if tracer.forcings:
+                forcings = np.zeros_like(tracer.state)
+                for f in tracer.forcings:
+                    forcings += f(tracer)
+                dstate[i] += forcings
+        return dstate
+
+    def apply_boundary_conditions(self):
+        self.grid.apply_boundary_conditions_to(self._state)
+
+
+class ShallowWaterTracer(object):
+    """A tracer of a ShallowWater model, see `ShallowWater.add_tracer`.
+    Its state is a view of one layer of the model's `TracerStack`."""
+    def __init__(self, name, stack):
+        self.name = name
+        self.grid = stack.grid
+        self._stack = stack
+        self.forcings = []
+
+    @property
+    def _index(self):
+        return self._stack.tracers.index(self)
+
+    @property
+    def _state(self):
+        return self._stack._state[self._index]
+
+    @property
+    def state(self):
+        # view without boundary conditions
+        return self._state[..., 1:-1, 1:-1]
+
+    @state.setter
+    def state(self, value):
+        self._state[..., 1:-1, 1:-1] = value
+
+    @property
+    def kappa(self):
+        return self._stack.kappa.flat[self._index]
+
+    @kappa.setter
+    def kappa(self, value):
+        self._stack.kappa[self._index] = value
+
+    @property
+    def damping(self):
+        return self._stack.damping.flat[self._index]
+
+    @damping.setter
+    def damping(self, value):
+        self._stack.damping[self._index] = value
+
+    @property
+    def dt(self):
+        return self.grid.dt
 
     def rhs(self):
         """Set a right-hand side term for the equation.
@@ -276,15 +525,14 @@ class ShallowWaterTracer(AdamsBashforth3):
         self.forcings.append(fn)
         return fn
 
-    def step(self):
-        self.apply_boundary_conditions()
-        self.state = self.state + self.dstate()
-        self._incr_timestep()
-
     def apply_boundary_conditions(self):
         self.grid.apply_boundary_conditions_to(self._state)
 
     def __getattr__(self, attr):
+        # only called when normal attribute lookup fails; don't look
+        # for private attributes in the state, e.g. while unpickling
+        if attr.startswith('_'):
+            raise AttributeError(attr)
         return getattr(self.state, attr)
 
     def __getitem__(self, slice):
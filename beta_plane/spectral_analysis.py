@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+import scipy.fft
 import scipy.signal
 
 
@@ -16,51 +17,156 @@ def best_fit(xs, ys):
 # the mixed-Rossby gravity waves plot the even modes m = 0,2,4,6...
 
 
-def best_fit(xs, ys):
-    """Using the method of least squares, return the gradient
-    and y-intercept of the line of best fit through xs and ys."""
-    A = np.array([xs, np.ones(len(xs))])
-    return np.linalg.lstsq(A.T,ys)[0]
+COMPONENTS = (None, 'symmetric', 'antisymmetric')
+
+
+def equatorial_component(u, component):
+    """The part of u (time, longitude, latitude) that is symmetric or
+    antisymmetric about the equator [Wheeler & Kiladis 1998]:
+
+        symmetric      (u(y) + u(-y)) / 2
+        antisymmetric  (u(y) - u(-y)) / 2
+
+    The latitudes must be symmetric about the equator, so that latitude j
+    mirrors latitude ny-1-j.  With component None u is returned unchanged."""
+    if component not in COMPONENTS:
+        raise ValueError("Unknown component '%s', use one of %s" % (component, COMPONENTS))
+    if component == 'symmetric':
+        return 0.5*(u + u[..., ::-1])
+    elif component == 'antisymmetric':
+        return 0.5*(u - u[..., ::-1])
+    return u
 
 
-def kiladis_spectra(u, dt=1.0, dx=1.0):
+def kiladis_spectra(u, dt=1.0, dx=1.0, component=None):
     """Perform Wheeler-Kiladis Spectral Analysis on variable u.
 
-        spinup: discard the first `spinup` days as initialisation
+    u is a sequence in time of fields in longitude and latitude (nt, nx, ny).
+    `component` selects the 'symmetric' or 'antisymmetric' part of u about
+    the equator, see `equatorial_component`.
 
-    Returns frequency-wavenumber spectra for each latitude.
+    All the latitudes are done together: the linear trend in time of the
+    zonal mean is removed with a closed form least squares fit, the ends
+    of the time series are tapered, and the band is transformed with one
+    real 2D FFT over (time, longitude).
+
+    Returns frequency-wavenumber spectra for each latitude (ny, nt, nx).
     """
-    v = np.asarray(u)
+    v = equatorial_component(np.asarray(u), component)
     nt, nx, ny = v.shape
 
+    # u in time and longitude at each latitude
+    data = np.ascontiguousarray(np.moveaxis(v, -1, 0), dtype=np.float64)   # (ny, nt, nx)
+
+    # remove the trend of the zonal mean u over time to leave
+    # perturbations centred on zero
     ts = np.arange(nt)*dt
-    xs = np.arange(nx)*dx
-
-    fts = []
-    for j in range(ny):
-        data = v[:,:,j]                    # u in time and longitude at given latitude
-        lng_avg = data.mean(axis=1)        # average u at each timestep
-        m, c = best_fit(ts, lng_avg)       # trend in time
-
-        # remove the trend of u over time to leave perturbations centred on zero
-        perturbations = data - (m*ts + c)[:, np.newaxis]
-
-        # window tapering - make the ends of the time window approach zero
-        #                 - use a cos^2 profile over a small number of samples at each end
-        taper = min(15, nt//20)  # taper over 30 time points, or 10% of the domain, whichever is smaller
-        perturbations[:taper,:] = perturbations[:taper,:] * (np.cos(np.linspace(-np.pi/2, 0, taper))**2)[:, np.newaxis]
-        perturbations[-taper:,:] = perturbations[-taper:,:] * (np.cos(np.linspace(0, np.pi/2, taper))**2)[:, np.newaxis]
-
-        lft = np.fft.fft(perturbations, axis=1)     # FFT in space
-        tft = np.fft.fft(lft, axis=0)               # FFT in time
-        fts.append(tft)
-    fts = np.array(fts)
+    tp = ts - ts.mean()
+    lng_avg = data.mean(axis=2)                                 # (ny, nt)
+    m = (lng_avg * tp).sum(axis=1) / (tp*tp).sum()
+    c = lng_avg.mean(axis=1) - m*ts.mean()
+    data -= (m[:, np.newaxis]*ts + c[:, np.newaxis])[..., np.newaxis]
+
+    # window tapering - make the ends of the time window approach zero
+    #                 - use a cos^2 profile over a small number of samples at each end
+    taper = min(15, nt//20)  # taper over 30 time points, or 10% of the domain, whichever is smaller
+    if taper > 0:
+        window = np.ones(nt)
+        window[:taper] = np.cos(np.linspace(-np.pi/2, 0, taper))**2
+        window[-taper:] = np.cos(np.linspace(0, np.pi/2, taper))**2
+        data *= window[:, np.newaxis]
+
+    # FFT in space, then time.  The data are real, so the transform of the
+    # negative wavenumbers is the conjugate of that at -k and -w
+    half = scipy.fft.rfft2(data, overwrite_x=True)
+    nk = half.shape[-1]
+    fts = np.empty((ny, nt, nx), dtype=half.dtype)
+    fts[..., :nk] = half
+    fts[..., nk:] = np.conj(half[:, -np.arange(nt), nx-nk:0:-1])
     # fourier transform in numpy is defined by exp(-2pi i (kx + wt))
     # but we want exp(kx - wt) so need to negate the x-domain
     fts = fts[:, :, ::-1]
     return fts
 
 
+class WelchKiladisSpectra(object):
+    """Wheeler-Kiladis power spectra of a long run, estimated online.
+
+    Samples of u in longitude and latitude are appended one at a time
+    to a ring buffer that holds one segment of `nperseg` samples.  Each
+    time a segment is complete its spectra are calculated, detrended and
+    tapered as in `kiladis_spectra`, and the power is added to a running
+    sum.  The segments overlap by `noverlap` samples (half a segment by
+    default), as in Welch's method, so the memory used is bounded and
+    each update is incremental however long the run.
+
+    >>> spectra = WelchKiladisSpectra(256, dt=10*ocean.dt)
+    >>> for i in range(nsteps):
+    ...     ocean.step()
+    ...     if i % 10 == 0:
+    ...         spectra.append(ocean.u[:, ny//2-5:ny//2+5])
+    >>> power = spectra.power.sum(axis=0)   # (nperseg, nx), summed over latitude
+
+    `dt` is the interval between samples.  `component` selects the
+    symmetric or antisymmetric part about the equator, see
+    `equatorial_component`.
+    """
+    def __init__(self, nperseg, noverlap=None, dt=1.0, dx=1.0, component=None):
+        if noverlap is None:
+            noverlap = nperseg // 2
+        if not 0 <= noverlap < nperseg:
+            raise ValueError('noverlap must be at least 0 and less than nperseg')
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.dt = dt
+        self.dx = dx
+        if component not in COMPONENTS:
+            raise ValueError("Unknown component '%s', use one of %s" % (component, COMPONENTS))
+        self.component = component
+
+        self.nsamples = 0
+        self.nsegments = 0
+        self._buffer = None
+        self._since = 0         # samples since the last segment
+        self._sum = None
+
+    def append(self, sample):
+        """Add the next sample, an array of (nx, ny)."""
+        sample = np.asarray(sample)
+        if self._buffer is None:
+            self._buffer = np.empty((self.nperseg,) + sample.shape, dtype=sample.dtype)
+        self._buffer[self.nsamples % self.nperseg] = sample
+        self.nsamples += 1
+        self._since += 1
+
+        if self.nsamples >= self.nperseg and (self.nsegments == 0 or self._since == self.nperseg - self.noverlap):
+            self._add_segment()
+
+    def _add_segment(self):
+        # the segment in time order, starting from the oldest sample
+        order = (self.nsamples + np.arange(self.nperseg)) % self.nperseg
+        segment = self._buffer[order]
+        power = np.abs(kiladis_spectra(segment, self.dt, self.dx, self.component))**2
+        if self._sum is None:
+            self._sum = power
+        else:
+            self._sum += power
+        self.nsegments += 1
+        self._since = 0
+
+    @property
+    def power(self):
+        """The power averaged over the segments so far, (ny, nperseg, nx)
+        in the layout of `kiladis_spectra`.  None before the first segment."""
+        if self._sum is None:
+            return None
+        return self._sum / self.nsegments
+
+    def frequencies(self):
+        """The frequencies of the power spectra [1/units of dt]."""
+        return np.fft.fftfreq(self.nperseg, self.dt)
+
+
 def background(spectra, fsteps=10, ksteps=10):
     """Uses a 1-2-1 filter to generate 'red noise' background field for a spectra (as per WK1998)
         `fsteps` is the number of times to apply the filter in the frequency direction
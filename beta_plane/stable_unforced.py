@@ -1,9 +1,8 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.signal
 
-from nonlinear import PeriodicShallowWater
-from spectral_analysis import kiladis_spectra, background
+from shallowwater import PeriodicShallowWater
+from spectral_analysis import WelchKiladisSpectra, background
 
 nx = 128
 ny = 129
@@ -34,8 +33,8 @@ colorlevels = np.concatenate([np.linspace(-1, -.05, num_levels//2), np.linspace(
 en = []
 qn = []
 
-eq_reg = []
-ts = []
+# power spectra of u about the equator, sampled every 10 steps
+spectra = WelchKiladisSpectra(256, dt=10*dt)
 
 hx, hy = np.meshgrid(ocean.phix, ocean.phiy)
 arrow_spacing = slice(ny // 16, None, ny // 9), slice(nx // 12, None, nx // 12)
@@ -48,8 +47,7 @@ for i in range(100000):
     #qbar[:] = ocean.tracer('q').mean()
 
     if i % 10 == 0:
-        eq_reg.append(ocean.u.copy()[:, ny//2-5:ny//2+5])
-        ts.append(ocean.t)
+        spectra.append(ocean.u[:, ny//2-5:ny//2+5])
 
     if i % 40 == 0:
 
@@ -80,13 +78,13 @@ for i in range(100000):
 
         plt.subplot(223)
 
-        if len(ts) > 50:
-            specs = kiladis_spectra(eq_reg)
-            spec = np.sum(specs, axis=0)
+        if spectra.nsegments:
+            # power summed over the latitudes
+            spec = spectra.power.sum(axis=0)
             nw, nk = spec.shape
             fspec = np.fft.fftshift(spec)
             fspec -= background(fspec, 10, 0)
-            om = np.fft.fftshift(np.fft.fftfreq(nw, ts[1]-ts[0]))
+            om = np.fft.fftshift(spectra.frequencies())
             k = np.fft.fftshift(np.fft.fftfreq(nk, 1.0/nk))
             #plt.pcolormesh(k, om, np.log(1 + np.abs(spec)**2))
             plt.pcolormesh(k, om, np.log(1+np.abs(fspec)), cmap=plt.cm.bone)
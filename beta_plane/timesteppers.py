@@ -1,47 +1,530 @@
+"""Timestepping schemes for the models, as mixin classes.
+
+A model provides the tendency of its state, `_rhs()`, and a `state` that can
+be read and assigned.  The integrator provides `dstate()`, the change of the
+state over a step of `dt`, and `step()`.  Multistage integrators evaluate
+`_rhs()` at intermediate states by temporarily assigning them to the model,
+calling `apply_boundary_conditions()` first if the model has it.
+
+Each integrator advertises its region of absolute stability for the
+equation dy/dt = λy, as the largest |λ dt| that is stable with λ on the
+negative real axis (`stability_real`, damping) and on the imaginary axis
+(`stability_imag`, oscillation).  `stable_dt()` uses these to choose the
+largest stable timestep.  `storage` is the number of state-sized arrays
+each integrator holds in addition to the model state and the tendency:
+for Adams-Bashforth, the previous tendencies and the increment.
+
+    Integrator          order  stability_real  stability_imag  storage
+    Euler                   1           2.0             0.0         0
+    AdamsBashforth2         2           1.0             0.0         2
+    AdamsBashforth3         3           0.545           0.723       3
+    SSPRK3                  3           2.51            1.73        2
+    RK4                     4           4.65            3.34        2
+    LeapfrogRAW             1*          0.198           0.437       1
+
+* second order without the filter.  The stability of LeapfrogRAW is for
+the default filter parameters.  The stages of the Runge-Kutta schemes are
+evaluated with the model time `t` set to the time of the stage.
+"""
+
+import numpy as np
+
+import kernels
+
+
+def _copy_state(state):
+    """A copy of `state`, which may be an object array of differently shaped fields."""
+    if state.dtype == object:
+        copy = np.empty_like(state)
+        for i, field in enumerate(state):
+            copy[i] = np.array(field)
+        return copy
+    return state.copy()
+
+
 class TimestepperMixin(object):
     """Calculate the time-tendencies and timestepping of the equation
         dstate/dt = _rhs()
+
+    Adaptive timestepping is switched on by setting `cfl`.  Before each step,
+    dt is chosen so that the Courant number `max_wave_speed()*dt/min(dx, dy)`
+    equals `cfl`, growing by at most a factor `dt_growth` per step and bounded
+    by `dt_min` and `dt_max`.  A step that gives a state with a Courant number
+    above `cfl_reject`, or that is not finite, is rolled back and retried with
+    half the timestep.  The model must provide `max_wave_speed(state)`.
+
+    AB3 is stable for gravity waves on the C-grid up to a Courant number of
+    about 0.25, so `cfl` should be a little below that.
     """
     t = 0.0
     tc = 0
 
+    cfl = None
+    cfl_reject = 0.35
+    dt_growth = 1.2
+    dt_min = 0.0
+    dt_max = np.inf
+    rejected_steps = 0
+
+    # attributes that hold the timestepping history, see `_checkpoint`
+    _history_names = ()
+
+    stability_real = 0.0
+    stability_imag = 0.0
+    storage = 0
+
     def step(self):
-        self.state[:] = self.state + self.dstate()
+        self._add_to_state(self._step_increment())
         self._incr_timestep()
 
     def _incr_timestep(self):
         self.t = self.t + self.dt
         self.tc = self.tc + 1
 
+    def set_adaptive_timestep(self, cfl=0.2, cfl_reject=0.35, dt_min=0.0, dt_max=np.inf, dt_growth=1.2):
+        """Choose dt at each step from the Courant number, see `TimestepperMixin`."""
+        self.cfl = cfl
+        self.cfl_reject = cfl_reject
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.dt_growth = dt_growth
+
+    def stable_dt(self, damping=0.0, frequency=0.0):
+        """The largest stable timestep for the fastest `damping` rate and
+        oscillation `frequency` [1/s] of the equations."""
+        dt = np.inf
+        if damping > 0:
+            dt = min(dt, self.stability_real / damping)
+        if frequency > 0:
+            dt = min(dt, self.stability_imag / frequency)
+        return dt
+
+    def _stage_rhs(self):
+        """The tendency of the model's current state, applying the boundary
+        conditions first.  Used for the stages of multistage integrators."""
+        if hasattr(self, 'apply_boundary_conditions'):
+            self.apply_boundary_conditions()
+        return self._rhs()
+
+    def _restore_state(self, state):
+        """Return the model to `state` after the stages of a step."""
+        self.state = state
+        if hasattr(self, 'apply_boundary_conditions'):
+            self.apply_boundary_conditions()
+
+    def courant_number(self, state=None, dt=None):
+        """The Courant number of `state` (default the current state) for a timestep `dt`."""
+        dt = self.dt if dt is None else dt
+        length = min(self.dx, getattr(self, 'dy', self.dx))
+        return self.max_wave_speed(state) * dt / length
+
+    def _next_dt(self):
+        """The timestep that gives a Courant number of `cfl` for the current state."""
+        dt = self.dt * self.dt_growth
+        speed = self.max_wave_speed()
+        if speed > 0:
+            dt = min(dt, self.cfl * min(self.dx, getattr(self, 'dy', self.dx)) / speed)
+        return max(min(dt, self.dt_max), self.dt_min)
+
+    def _add_to_state(self, dstate):
+        """Add an increment to the state in place."""
+        for field, increment in zip(_fields(self.state), _fields(dstate)):
+            field += increment
+
+    def _step_increment(self):
+        """The increment of the state over the next step.  When `cfl` is set,
+        dt is adapted and rejected steps are retried with a smaller timestep."""
+        if self.cfl is None:
+            return self.dstate()
+
+        self.dt = self._next_dt()
+        checkpoint = self._checkpoint()
+        while True:
+            dstate = self.dstate()
+            if self._accept(self.state + dstate):
+                return dstate
+            self._rollback(checkpoint)
+            if self.dt <= self.dt_min:
+                raise RuntimeError('Step rejected with the minimum timestep dt=%g' % self.dt)
+            self.dt = max(0.5*self.dt, self.dt_min)
+            self.rejected_steps = self.rejected_steps + 1
+
+    def _accept(self, newstate):
+        """Test a new state against the stability threshold `cfl_reject`."""
+        if not all(np.isfinite(field).all() for field in newstate):
+            return False
+        return self.courant_number(newstate) <= self.cfl_reject
+
+    def _checkpoint(self):
+        """Save the timestepping history, which is updated by `dstate()`."""
+        return dict((name, getattr(self, name)) for name in self._history_names)
+
+    def _rollback(self, checkpoint):
+        """Restore the timestepping history from a `_checkpoint()`."""
+        for name, value in checkpoint.items():
+            setattr(self, name, value)
+
+
 class Euler(TimestepperMixin):
+    stability_real = 2.0
+
     def dstate(self):
         dstate =  self.dt*self._rhs()
         return dstate
 
 
-class AdamsBashforth3(TimestepperMixin):
-    _pfstate, _ppfstate = 0.0, 0.0
+class TendencyHistory(object):
+    """The tendencies of the last `k` steps, and their timesteps, in a ring
+    buffer of preallocated arrays.  history[0] is the most recent tendency.
+
+    The arrays are allocated by the first `push`.  `next_slot()` is the
+    storage that the next tendency will be pushed into, which holds the
+    oldest tendency: a model can calculate its tendency in place there,
+    so that `push` doesn't need to copy it.
+    """
+    def __init__(self, k):
+        self.k = k
+        self.count = 0
+        self._slots = [None]*k
+        self._dts = [None]*k
+        self._head = 0
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return (self._head - n) % self.k
+
+    def __getitem__(self, n):
+        return self._slots[self._index(n)]
+
+    def dt(self, n):
+        """The timestep of the step that used tendency `n`."""
+        return self._dts[self._index(n)]
+
+    def next_slot(self):
+        """The storage of the next tendency, None until it has been allocated."""
+        return self._slots[(self._head + 1) % self.k]
+
+    def push(self, fstate, dt):
+        i = (self._head + 1) % self.k
+        slot = self._slots[i]
+        if slot is None:
+            slot = self._slots[i] = _empty_state(fstate)
+        if slot is not fstate:
+            for field, value in zip(_fields(slot), _fields(fstate)):
+                field[...] = value
+        self._dts[i] = dt
+        self._head = i
+        self.count = min(self.count + 1, self.k)
+
+    def mark(self):
+        """The position in the history, to `reset` to after a rejected step."""
+        return self._head, self.count, list(self._dts)
+
+    def reset(self, mark):
+        self._head, self.count, self._dts = mark[0], mark[1], list(mark[2])
+
+    def get_state(self):
+        """The history as a list of (dt, tendency) pairs, most recent first.
+        The tendencies are copies, so the list can be saved for a restart."""
+        return [(self.dt(n), _copy_state(self[n])) for n in range(self.count)]
+
+    def set_state(self, history):
+        """Restore the history from the result of `get_state()`."""
+        self.count = 0
+        for dt, fstate in reversed(history):
+            self.push(fstate, dt)
+
+
+def _fields(state):
+    """The arrays of a state, which may be an object array of fields."""
+    if state.dtype == object:
+        return list(state)
+    return [state]
+
+
+def _empty_state(like):
+    if like.dtype == object:
+        empty = np.empty_like(like)
+        for i, field in enumerate(like):
+            empty[i] = np.empty_like(field)
+        return empty
+    return np.empty_like(like)
+
+
+def _linear_combination(out, coefficients, states):
+    """out = sum(c*state), field by field.  Fused into a single pass over
+    the arrays with numba, otherwise evaluated in place with one scratch array.
+    Both give the same result as evaluating the sum left to right."""
+    for fields in zip(_fields(out), *[_fields(state) for state in states]):
+        out_field, arrays = fields[0], fields[1:]
+        if kernels.NUMBA and len(arrays) > 1 and out_field.flags.c_contiguous:
+            args = []
+            for c, array in zip(coefficients, arrays):
+                args += [c, np.ravel(array)]
+            combine = kernels.combine2 if len(arrays) == 2 else kernels.combine3
+            combine(out_field.reshape(-1), *args)
+        else:
+            np.multiply(arrays[0], coefficients[0], out=out_field)
+            if len(arrays) > 1:
+                tmp = np.empty_like(out_field)
+                for c, array in zip(coefficients[1:], arrays[1:]):
+                    out_field += np.multiply(array, c, out=tmp)
+
+
+class AdamsBashforth(TimestepperMixin):
+    """Adams-Bashforth timestepping of order `order`.
+
+    The tendencies of the previous steps are held in a `TendencyHistory`.
+    A model that calculates its tendency into `_tendency_storage()` and
+    steps with `step()` makes no allocations: the tendency is written into
+    the history, the tendencies are combined into a preallocated increment
+    and the increment is added to the state in place.
+
+    The history can be saved with `get_history()` and restored with
+    `set_history()` to restart a run.  The first steps after a start
+    without history have a lower order.
+    """
+    order = 3
+    _history = None
+    _increment = None
+
+    def _coefficients(self, dt, history):
+        """The coefficients of the current and previous tendencies."""
+        raise NotImplementedError
+
+    def _tendency_history(self):
+        if self._history is None:
+            self._history = TendencyHistory(self.order)
+        return self._history
 
     def dstate(self):
         dt = self.dt
+        history = self._tendency_history()
         fstate = self._rhs()
 
-        if self.tc == 0:
+        coefficients = self._coefficients(dt, history)
+        if self._increment is None:
+            self._increment = _empty_state(fstate)
+        states = [fstate] + [history[n] for n in range(len(coefficients)-1)]
+        _linear_combination(self._increment, coefficients, states)
+
+        history.push(fstate, dt)
+        return self._increment
+
+    def _tendency_storage(self):
+        if self._history is None:
+            return None
+        return self._history.next_slot()
+
+    def get_history(self):
+        """The tendency history as a list of (dt, tendency), see `TendencyHistory`."""
+        if self._history is None:
+            return []
+        return self._history.get_state()
+
+    def set_history(self, history):
+        self._history = TendencyHistory(self.order)
+        self._history.set_state(history)
+
+    def _checkpoint(self):
+        checkpoint = super(AdamsBashforth, self)._checkpoint()
+        checkpoint['_history'] = self._tendency_history().mark()
+        return checkpoint
+
+    def _rollback(self, checkpoint):
+        checkpoint = dict(checkpoint)
+        self._history.reset(checkpoint.pop('_history'))
+        super(AdamsBashforth, self)._rollback(checkpoint)
+
+
+class AdamsBashforth2(AdamsBashforth):
+    """Second order Adams-Bashforth timestepping.
+
+    Stores the previous tendency.  AB2 is weakly unstable for oscillations,
+    so it suits damped equations; the coefficients allow a changing timestep."""
+    order = 2
+    stability_real = 1.0
+    storage = 2
+
+    def _coefficients(self, dt, history):
+        if len(history) == 0:
+            # first step Euler
+            return (dt,)
+        r = 0.5 * dt / history.dt(0)
+        return ((1 + r)*dt, -r*dt)
+
+
+class AdamsBashforth3(AdamsBashforth):
+    """Third order Adams-Bashforth timestepping.
+
+    Stores the two previous tendencies.  The coefficients allow for a
+    timestep that changes between steps, see `TimestepperMixin` for
+    adaptive timestepping."""
+    order = 3
+    stability_real = 0.545
+    stability_imag = 0.723
+    storage = 3
+
+    def _coefficients(self, dt, history):
+        if len(history) == 0:
             # first step Euler
             dt1 = dt
-            dstate = dt1*fstate
+            return (dt1,)
 
-        elif self.tc == 1:
-            dt1 = 1.5*dt
-            dt2 = -0.5*dt
-            dstate = dt1*fstate + dt2*self._pfstate
+        elif len(history) == 1:
+            if dt == history.dt(0):
+                dt1 = 1.5*dt
+                dt2 = -0.5*dt
+            else:
+                r = 0.5 * dt / history.dt(0)
+                dt1 = (1 + r)*dt
+                dt2 = -r*dt
+            return (dt1, dt2)
 
         else:
-            dt1 = 23./12.*dt
-            dt2 = -16./12.*dt
-            dt3 = 5./12.*dt
-            dstate = dt1*fstate + dt2*self._pfstate + dt3*self._ppfstate
-
-        # update the cached previous fstate values
-        self._ppfstate, self._pfstate = self._pfstate, fstate
-        return dstate
\ No newline at end of file
+            a, b = history.dt(0), history.dt(1)
+            if dt == a == b:
+                dt1 = 23./12.*dt
+                dt2 = -16./12.*dt
+                dt3 = 5./12.*dt
+            else:
+                # integrate the quadratic through the last three fstates
+                # at t, t-a and t-a-b from t to t+dt
+                dt1 = (dt**3/3 + (2*a + b)*dt**2/2 + a*(a + b)*dt) / (a*(a + b))
+                dt2 = -(dt**3/3 + (a + b)*dt**2/2) / (a*b)
+                dt3 = (dt**3/3 + a*dt**2/2) / (b*(a + b))
+            return (dt1, dt2, dt3)
+
+
+class SSPRK3(TimestepperMixin):
+    """Third order strong stability preserving Runge-Kutta [Shu & Osher 1988].
+
+        u1 = u + dt f(u)
+        u2 = 3/4 u + 1/4 (u1 + dt f(u1))
+        u' = 1/3 u + 2/3 (u2 + dt f(u2))
+
+    The stages are held in the model state, so only a copy of the
+    initial state and the tendency of the stage are stored."""
+    stability_real = 2.51
+    stability_imag = 1.73
+    storage = 2
+
+    def dstate(self):
+        dt, t0 = self.dt, self.t
+        state0 = _copy_state(self.state)
+
+        self.state = state0 + dt*self._stage_rhs()
+        self.t = t0 + dt
+        self.state = 0.75*state0 + 0.25*(self.state + dt*self._stage_rhs())
+        self.t = t0 + 0.5*dt
+        dstate = (2.0/3.0)*(self.state + dt*self._stage_rhs()) - (2.0/3.0)*state0
+
+        self.t = t0
+        self._restore_state(state0)
+        return dstate
+
+
+class RK4(TimestepperMixin):
+    """Fourth order, five stage Runge-Kutta in 2N low-storage form
+    [Carpenter & Kennedy 1994].  Each stage is
+
+        du = A[i] du + dt f(u)
+        u = u + B[i] du
+
+    so the register `du` and a copy of the initial state are stored.  The
+    register and the model state are updated in place, with the tendency
+    of the stage as the scratch space.
+    Its stability region is larger than that of the classical RK4."""
+    A = (0.0,
+         -567301805773.0/1357537059087.0,
+         -2404267990393.0/2016746695238.0,
+         -3550918686646.0/2091501179385.0,
+         -1275806237668.0/842570457699.0)
+    B = (1432997174477.0/9575080441755.0,
+         5161836677717.0/13612068292357.0,
+         1720146321549.0/2090206949498.0,
+         3134564353537.0/4481467310338.0,
+         2277821191437.0/14882151754819.0)
+    # the time of each stage, as a fraction of dt
+    C = (0.0,
+         1432997174477.0/9575080441755.0,
+         2526269341429.0/6820363962896.0,
+         2006345519317.0/3224310063776.0,
+         2802321613138.0/2924317926251.0)
+    stability_real = 4.65
+    stability_imag = 3.34
+    storage = 2
+
+    def dstate(self):
+        dt, t0 = self.dt, self.t
+        state0 = _copy_state(self.state)
+
+        du = None
+        for a, b, c in zip(self.A, self.B, self.C):
+            self.t = t0 + c*dt
+            rhs = self._stage_rhs()
+            if du is None:
+                du = _empty_state(rhs)
+                for field in _fields(du):
+                    field[...] = 0.0
+            for state, register, scratch in zip(_fields(self.state), _fields(du), _fields(rhs)):
+                register *= a
+                scratch *= dt
+                register += scratch
+                np.multiply(register, b, out=scratch)
+                state += scratch
+        dstate = self.state - state0
+
+        self.t = t0
+        self._restore_state(state0)
+        return dstate
+
+
+class LeapfrogRAW(TimestepperMixin):
+    """Leapfrog timestepping with the Robert-Asselin-Williams filter [Williams 2009].
+
+        u(n+1) = u(n-1) + 2 dt f(u(n))
+        d = nu/2 (u(n-1) - 2u(n) + u(n+1))
+        u(n) += alpha d,  u(n+1) += (alpha-1) d
+
+    Stores the filtered previous state.  The first step is a forward Euler
+    step.  When the timestep changes, with r = dt/dt(n-1), the step is the
+    second order leapfrog over the unequal steps
+
+        u(n+1) = (1 - r^2) u(n) + r^2 u(n-1) + (1 + r) dt f(u(n))
+        d = nu/(1+r) (r u(n-1) - (1+r) u(n) + u(n+1))
+
+    so adaptive timestepping keeps it leapfrog.  `raw_nu` and `raw_alpha`
+    are the filter parameters; alpha=1 is the Robert-Asselin filter.
+    Leapfrog is unstable for strong damping: dissipation terms should be small."""
+    raw_nu = 0.2
+    raw_alpha = 0.53
+    _pstate = None
+    _pdt = None
+    _history_names = ('_pstate', '_pdt')
+    stability_real = 0.198
+    stability_imag = 0.437
+    storage = 1
+
+    def dstate(self):
+        dt = self.dt
+        state = self.state
+        fstate = self._rhs()
+
+        if self._pstate is None:
+            # first step Euler
+            newstate = state + dt*fstate
+            self._pstate = _copy_state(state)
+        else:
+            r = dt / self._pdt
+            newstate = (1.0 - r*r)*state + r*r*self._pstate + (1.0 + r)*dt*fstate
+            d = self.raw_nu/(1.0 + r)*(r*self._pstate - (1.0 + r)*state + newstate)
+            self._pstate = state + self.raw_alpha*d
+            newstate = newstate + (self.raw_alpha - 1.0)*d
+
+        self._pdt = dt
+        return newstate - state
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Ensemble data assimilation for the Würsch-Craig model.
+
+`Observations` are values of u, h or r at grid points of the model, with
+their error standard deviations.  For twin experiments they are taken from
+a truth run with `Observations.synthetic`.
+
+`LETKF` is the local ensemble transform Kalman filter [Hunt et al. 2007].
+Every grid point is analysed with the observations within twice the
+`localisation` length scale, weighted by the Gaspari-Cohn function.  The
+analyses of all the grid points are done together, as batched matrix
+products and one batched eigendecomposition of the m x m matrices in
+ensemble space, so there is no loop over grid points.
+
+    truth = WurschCraigModel(seed=1)
+    ensemble = WurschCraigModel(seed=2, n_members=50)
+    letkf = LETKF(localisation=5000.0, inflation=1.05)
+    points = np.arange(0, truth.N, 4)
+    for cycle in range(ncycles):
+        truth.advance(300)
+        ensemble.advance(300)
+        obs = Observations.synthetic(truth, 'h', points, 0.01, rng)
+        letkf.analyse(ensemble, obs)
+"""
+
+import numpy as np
+
+
+VARIABLES = ('u', 'h', 'r')
+
+
+def gaspari_cohn(r):
+    """The fifth order piecewise rational correlation function of
+    Gaspari & Cohn (1999), for distances `r` in units of the length
+    scale.  It is one at r=0 and zero for r >= 2."""
+    r = np.abs(np.asarray(r, dtype=np.float64))
+    c = np.zeros_like(r)
+    near = r <= 1
+    far = (r > 1) & (r < 2)
+    x = r[near]
+    c[near] = -0.25*x**5 + 0.5*x**4 + 0.625*x**3 - 5.0/3.0*x**2 + 1.0
+    x = r[far]
+    c[far] = x**5/12.0 - 0.5*x**4 + 0.625*x**3 + 5.0/3.0*x**2 - 5.0*x + 4.0 - 2.0/(3.0*x)
+    return c
+
+
+def _state(model):
+    """u, h and r of the model, stacked along the second last axis."""
+    return np.stack([model.u, model.h, model.r], axis=-2)
+
+
+class Observations(object):
+    """Observations of the model `variables` (names from VARIABLES, or
+    their indices) at grid `points`, with error standard deviations
+    `errors`.  A single variable or error applies to all the points."""
+    def __init__(self, variables, points, errors, values=None):
+        points = np.asarray(points, dtype=int)
+        if isinstance(variables, str):
+            variables = [variables]
+        variables = [VARIABLES.index(v) if isinstance(v, str) else v for v in variables]
+        self.variables = np.broadcast_to(variables, points.shape).copy()
+        self.points = points
+        self.errors = np.broadcast_to(np.asarray(errors, dtype=np.float64), points.shape).copy()
+        self.values = values
+
+    def __len__(self):
+        return self.points.size
+
+    def equivalents(self, model):
+        """The observed values of the model state, with shape
+        (n_members, nobs) for an ensemble."""
+        return _state(model)[..., self.variables, self.points]
+
+    @classmethod
+    def synthetic(cls, truth, variables, points, errors, rng):
+        """Observations of the `truth` model with random errors
+        from the np.random.Generator `rng`."""
+        obs = cls(variables, points, errors)
+        obs.values = obs.equivalents(truth) + obs.errors*rng.standard_normal(len(obs))
+        return obs
+
+
+class LETKF(object):
+    """The local ensemble transform Kalman filter.
+
+    `localisation` is the Gaspari-Cohn length scale [m]: observations
+    further than 2*localisation from a grid point have no influence on
+    its analysis.  `inflation` is the multiplicative inflation of the
+    background covariance.  With `clip_rain` negative analysed rain is
+    set to zero.
+    """
+    def __init__(self, localisation, inflation=1.0, clip_rain=True):
+        self.localisation = localisation
+        self.inflation = inflation
+        self.clip_rain = clip_rain
+
+    def local_observations(self, model, obs):
+        """For every grid point, the indices and localisation weights of
+        its local observations, with shape (N, nlocal).  Grid points with
+        fewer local observations are padded with zero weights."""
+        d = np.abs(model.x[:, np.newaxis] - model.x[obs.points])
+        d = np.minimum(d, model.X - d)  # periodic distance
+        weights = gaspari_cohn(d / self.localisation)
+        nlocal = max(1, int((weights > 0).sum(axis=1).max()))
+        index = np.argpartition(-weights, nlocal-1, axis=1)[:, :nlocal]
+        return index, np.take_along_axis(weights, index, axis=1)
+
+    def weights(self, Yb, obs, index, weights):
+        """The transform of the ensemble at each grid point, shape
+        (N, m, m), from the ensemble observation equivalents `Yb`."""
+        m = Yb.shape[0]
+        ybar = Yb.mean(axis=0)
+        Yp = (Yb - ybar).T                              # (nobs, m)
+
+        # the local observation perturbations, innovations and
+        # localised inverse error variances of each grid point
+        Yl = Yp[index]                                  # (N, nlocal, m)
+        dl = (obs.values - ybar)[index]                 # (N, nlocal)
+        rinv = weights / obs.errors[index]**2           # (N, nlocal)
+
+        C = np.swapaxes(Yl * rinv[..., np.newaxis], 1, 2)  # (N, m, nlocal)
+        A = np.matmul(C, Yl)
+        A[:, np.arange(m), np.arange(m)] += (m - 1) / self.inflation
+
+        # Pa = A^-1 and Wa = ((m-1) Pa)^1/2 from the eigendecomposition of A
+        lam, U = np.linalg.eigh(A)
+        Pa = np.matmul(U / lam[:, np.newaxis, :], np.swapaxes(U, 1, 2))
+        Wa = np.matmul(U * np.sqrt((m - 1) / lam)[:, np.newaxis, :], np.swapaxes(U, 1, 2))
+        wbar = np.matmul(Pa, np.matmul(C, dl[..., np.newaxis]))    # (N, m, 1)
+        return Wa + wbar
+
+    def analyse(self, model, obs):
+        """Assimilate the observations `obs` into the ensemble `model`,
+        updating its state.  Returns the analysis, with shape
+        (n_members, 3, N) for the VARIABLES."""
+        if model.n_members is None:
+            raise ValueError('The LETKF needs an ensemble model, see n_members')
+        xb = _state(model)                              # (m, 3, N)
+        xbar = xb.mean(axis=0)
+        Xp = xb - xbar
+
+        index, weights = self.local_observations(model, obs)
+        W = self.weights(obs.equivalents(model), obs, index, weights)
+
+        xa = xbar + np.einsum('ivj,jik->kvj', Xp, W)
+        if self.clip_rain:
+            np.maximum(xa[:, 2], 0.0, out=xa[:, 2])
+        model.update(xa[:, 0], xa[:, 1], xa[:, 2])
+        return xa
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Fused kernel for many steps of the Würsch-Craig model.
+
+`advance` runs the perturbations, the leapfrog step of the u, h and r
+equations and the RAW filter of `WurschCraigModel.step` for a whole run of
+steps in one call, passing over the grid once per step.  It is compiled with
+Numba when it is available; `NUMBA` is False otherwise and the model falls
+back to stepping with NumPy whole-array operations.
+
+The periodic neighbours of point j are jm = j-1 and jp = j+1 modulo n.
+"""
+
+try:
+    import numba
+    NUMBA = True
+except ImportError:
+    numba = None
+    NUMBA = False
+
+
+def _jit(fn):
+    if NUMBA:
+        return numba.njit(cache=True)(fn)
+    return fn
+
+
+@_jit
+def add_perturbation(u, xn, offsets, kernel):
+    """Add the perturbation of an event at grid point `xn` to u, see
+    `WurschCraigModel.perturbation_kernel`."""
+    n = u.size
+    for i in range(kernel.size):
+        u[(xn + offsets[i]) % n] += kernel[i]
+
+
+@_jit
+def cyclic_solve(x, lower, cp, inv, z, factor, corner):
+    """Solve a periodic tridiagonal system in place, with the factors of
+    a numerics.CyclicTridiagonalSolver."""
+    n = x.size
+    x[0] = x[0]*inv[0]
+    for j in range(1, n):
+        x[j] = (x[j] - lower[j-1]*x[j-1])*inv[j]
+    for j in range(n-2, -1, -1):
+        x[j] -= cp[j]*x[j+1]
+    vy = factor*(x[0] + corner*x[n-1])
+    for j in range(n):
+        x[j] -= vy*z[j]
+
+
+@_jit
+def advance(u, h, r, _u, _h, _r, H, counts, positions, offsets, kernel,
+            dx, dt, g, Hc, Hr, phi_c, c2, beta, alpha, Ku, Kh, Kr,
+            raw_nu, raw_alpha, u_, h_, r_, implicit, su, sh, sr):
+    """Take len(counts) steps.  counts[k] events are added at step k, at
+    the grid points that follow in `positions`, each the perturbation
+    `kernel` at `offsets` from the event.  With `implicit` the diffusion
+    is solved with the factors `su`, `sh` and `sr` of the u, h and r
+    diffusion solvers, see `cyclic_solve`."""
+    n = u.size
+    cu = dt/(2.0*dx)
+    cp = 2.0*dt/dx
+    ch = dt/dx
+    ku = Ku*dt/(dx*dx)
+    kh = Kh*dt/(dx*dx)
+    kr = Kr*dt/(dx*dx)
+    if implicit:
+        ku = kh = kr = 0.0
+
+    event = 0
+    for k in range(counts.size):
+        for _ in range(counts[k]):
+            add_perturbation(u, positions[event], offsets, kernel)
+            event += 1
+
+        for j in range(n):
+            jm = j - 1
+            jp = (j + 1) % n
+
+            # the modified geopotential, reduced where convection is triggered
+            z = H[j] + h[j]
+            P = phi_c + g*H[j] if z > Hc else g*z
+            zm = H[jm] + h[jm]
+            Pm = phi_c + g*H[jm] if zm > Hc else g*zm
+
+            u_[j] = (_u[j] - cu*(u[jp]**2 - u[jm]**2)
+                     - cp*((P + c2*r[j]) - (Pm + c2*r[jm]))
+                     + ku*(_u[jm] - 2.0*_u[j] + _u[jp]))
+
+            momentum = u[j]*(h[jm] + h[j])
+            momentum_p = u[jp]*(h[j] + h[jp])
+            h_[j] = (_h[j] - ch*(momentum_p - momentum)
+                     + kh*(_h[jm] - 2.0*_h[j] + _h[jp]))
+
+            # the rain equation: rain is produced where the fluid is above
+            # the rain threshold and converging
+            ux = u[jp] - u[j]
+            beta_a = beta if z > Hr and ux < 0 else 0.0
+            r_[j] = (_r[j] - alpha*dt*2.0*r[j] - 2*beta_a*ch*ux
+                     - cu*(u[jp] + u[j])*(r[jp] - r[jm])
+                     + kr*(_r[jm] - 2.0*_r[j] + _r[jp]))
+
+        if implicit:
+            cyclic_solve(u_, su[0], su[1], su[2], su[3], su[4], su[5])
+            cyclic_solve(h_, sh[0], sh[1], sh[2], sh[3], sh[4], sh[5])
+            cyclic_solve(r_, sr[0], sr[1], sr[2], sr[3], sr[4], sr[5])
+
+        # the RAW filter, see numerics.RAW_filter
+        for j in range(n):
+            d = raw_nu*0.5*(_u[j] - 2.0*u[j] + u_[j])
+            _u[j] = u[j] + raw_alpha*d
+            u[j] = u_[j] + (raw_alpha - 1)*d
+            d = raw_nu*0.5*(_h[j] - 2.0*h[j] + h_[j])
+            _h[j] = h[j] + raw_alpha*d
+            h[j] = h_[j] + (raw_alpha - 1)*d
+            d = raw_nu*0.5*(_r[j] - 2.0*r[j] + r_[j])
+            _r[j] = r[j] + raw_alpha*d
+            r[j] = r_[j] + (raw_alpha - 1)*d
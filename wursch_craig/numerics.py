@@ -4,15 +4,22 @@
 
 import numpy as np
 
+try:
+    import scipy.sparse
+    import scipy.linalg.lapack
+    SCIPY = True
+except ImportError:
+    SCIPY = False
+
 
 def tridiag(n, d, u, l):
     """Create an nxn tridiagonal matrix with `d` along diagonal, `u` on
     first upper diag and `l` on first lower"""
     M = np.zeros((n,n))
-    i,j = np.indices((n,n))
-    M[i == j] = d
-    M[i == j-1] = u
-    M[i == j+1] = l
+    i = np.arange(n)
+    M[i, i] = d
+    M[i[:-1], i[1:]] = u
+    M[i[1:], i[:-1]] = l
     return M
 
 def stencil(n, _i, i, i_):
@@ -31,6 +38,147 @@ def stencil(n, _i, i, i_):
     m[0,-1] = _i
     return m
 
+def tridiag_banded(n, d, u, l):
+    """The nxn tridiagonal matrix of `tridiag` in banded storage: a (3, n)
+    array of the upper, main and lower diagonals, as used by
+    scipy.linalg.solve_banded.  The unused ab[0, 0] and ab[2, -1] are zero."""
+    ab = np.zeros((3, n))
+    ab[0, 1:] = u
+    ab[1] = d
+    ab[2, :-1] = l
+    return ab
+
+def stencil_banded(n, _i, i, i_):
+    """The periodic stencil matrix of `stencil` in banded storage.  The
+    corners of the periodic matrix, m[0, -1] = _i and m[-1, 0] = i_, are
+    held in the otherwise unused ab[0, 0] and ab[2, -1]."""
+    ab = tridiag_banded(n, i, i_, _i)
+    ab[0, 0] = _i
+    ab[2, -1] = i_
+    return ab
+
+def tridiag_sparse(n, d, u, l):
+    """The nxn tridiagonal matrix of `tridiag` as a scipy.sparse CSR matrix."""
+    return scipy.sparse.diags([l, d, u], [-1, 0, 1], shape=(n, n), format='csr')
+
+def stencil_sparse(n, _i, i, i_):
+    """The periodic stencil matrix of `stencil` as a scipy.sparse CSR matrix."""
+    return scipy.sparse.diags([i_, _i, i, i_, _i], [-(n-1), -1, 0, 1, n-1],
+                              shape=(n, n), format='csr')
+
+class CyclicTridiagonalSolver(object):
+    """Solve the periodic tridiagonal systems stencil(n, _i, i, i_) x = b.
+
+    >>> solver = CyclicTridiagonalSolver(N, -k, 1+2*k, -k)
+    >>> x = solver(b)
+
+    The corners of the periodic matrix are split off as a rank one update,
+    A = T + u v^T, and the solution found from solves with the tridiagonal
+    T by the Sherman-Morrison formula:
+
+        x = y - (v.y / (1 + v.z)) z,    T y = b,  T z = u
+
+    T is factored once, and z found, when the solver is made, so each
+    solve is a forward and back substitution in O(n).  The factors are
+    from LAPACK (dgttrf) with scipy, otherwise from the Thomas algorithm,
+    without pivoting: the matrix should be diagonally dominant.  `b` can
+    be a stack of vectors along its last axis.
+    """
+    def __init__(self, n, _i, i, i_):
+        if n < 3:
+            raise ValueError('The cyclic solver needs n >= 3')
+        self.n = n
+        gamma = -i
+        self._corner = _i/gamma   # v = (1, 0, ..., 0, _i/gamma)
+
+        # the tridiagonal part, with the diagonal modified by the corners
+        lower = np.full(n-1, float(_i))
+        diag = np.full(n, float(i))
+        upper = np.full(n-1, float(i_))
+        diag[0] -= gamma
+        diag[-1] -= i_*_i/gamma
+
+        # the Thomas algorithm factors of T, which also suit a compiled
+        # solve, see `thomas_solve`
+        self.lower = lower
+        self.cp = np.empty(n-1)
+        self.inv = np.empty(n)
+        self.inv[0] = 1.0/diag[0]
+        for j in range(1, n):
+            self.cp[j-1] = upper[j-1]*self.inv[j-1]
+            self.inv[j] = 1.0/(diag[j] - lower[j-1]*self.cp[j-1])
+
+        if SCIPY:
+            self._lapack = scipy.linalg.lapack.dgttrf(lower, diag, upper)
+        else:
+            self._lapack = None
+
+        u = np.zeros(n)
+        u[0] = gamma
+        u[-1] = i_
+        self.z = self._tridiagonal_solve(u)
+        self.factor = 1.0/(1.0 + self.z[0] + self._corner*self.z[-1])
+
+    def _tridiagonal_solve(self, b):
+        if self._lapack is not None:
+            dl, d, du, du2, ipiv, info = self._lapack
+            rhs = np.reshape(b, (-1, self.n)).T
+            x, info = scipy.linalg.lapack.dgttrs(dl, d, du, du2, ipiv, rhs)
+            return x.T.reshape(np.shape(b))
+        return thomas_solve(self.lower, self.cp, self.inv, np.asarray(b, dtype=np.float64))
+
+    def __call__(self, b):
+        y = self._tridiagonal_solve(b)
+        vy = y[..., :1] + self._corner*y[..., -1:]
+        return y - (self.factor*vy)*self.z
+
+def thomas_solve(lower, cp, inv, b):
+    """Solve a tridiagonal system with the factors of the Thomas algorithm,
+    see CyclicTridiagonalSolver.  `b` can be a stack of vectors along its
+    last axis, which are solved together."""
+    x = np.empty(b.shape)
+    x[..., 0] = b[..., 0]*inv[0]
+    for j in range(1, b.shape[-1]):
+        x[..., j] = (b[..., j] - lower[j-1]*x[..., j-1])*inv[j]
+    for j in range(b.shape[-1]-2, -1, -1):
+        x[..., j] -= cp[j]*x[..., j+1]
+    return x
+
+class PeriodicStencil(object):
+    """Apply periodic 3-point stencils to vectors of length n in O(n).
+
+    >>> S = PeriodicStencil(N)
+    >>> avg_v = S(v, 0, 0.5, 0.5)
+
+    gives the same result as np.dot(stencil(N, 0, 0.5, 0.5), v) without
+    building the nxn matrix: out_j = _s v_{j-1} + s v_j + s_ v_{j+1}.
+    `v` can be a stack of vectors along its last axis, such as an ensemble.
+    The result is written into `out` when given.  The terms are summed in
+    a work array kept for each shape, so a call with `out` allocates nothing.
+    """
+    def __init__(self, n):
+        self.n = n
+        self._work = {}
+
+    def __call__(self, phi, _s, s, s_, out=None):
+        phi = np.asarray(phi, dtype=np.float64)
+        if out is None:
+            out = np.empty(phi.shape)
+        work = self._work.get(phi.shape)
+        if work is None:
+            work = self._work[phi.shape] = np.empty(phi.shape)
+
+        # the neighbours are summed before the centre, as in the
+        # matrix product, so the results are identical
+        np.multiply(phi[..., :-1], _s, out=out[..., 1:])
+        np.multiply(phi[..., -1], _s, out=out[..., 0])
+        np.multiply(phi[..., 1:], s_, out=work[..., :-1])
+        np.multiply(phi[..., 0], s_, out=work[..., -1])
+        np.add(out, work, out=out)
+        np.multiply(phi, s, out=work)
+        np.add(out, work, out=out)
+        return out
+
 def RAW_filter(_phi, phi, phi_, nu=0.1, alpha=0.53):
     """The RAW time filter, an improvement on RA filter.
 
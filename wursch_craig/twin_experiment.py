@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A cycled twin experiment with the LETKF and the Würsch-Craig model.
+
+    python twin_experiment.py [n_members] [ncycles] [backend]
+
+A truth run is observed every `CYCLE` seconds, with errors, and the
+observations are assimilated into an ensemble with its own random
+perturbations.  The root mean square error of the ensemble mean and the
+ensemble spread are printed before and after each analysis.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from shallow1d import WurschCraigModel, seconds_to_time
+from assimilation import LETKF, Observations
+
+
+SPIN_UP = 3600          # [s] before the first analysis
+CYCLE = 300             # [s] between analyses
+OBS_EVERY = 4           # observe every OBS_EVERY grid points
+OBS_ERRORS = {'u': 1.0e-3, 'h': 5.0e-3, 'r': 1.0e-5}
+LOCALISATION = 4000.0   # [m]
+INFLATION = 1.1
+
+
+def scores(ensemble, truth, name):
+    """The rmse of the ensemble mean and the ensemble spread of `name`."""
+    values = getattr(ensemble, name)
+    rmse = np.sqrt(((values.mean(axis=0) - getattr(truth, name))**2).mean())
+    spread = np.sqrt(values.var(axis=0, ddof=1).mean())
+    return rmse, spread
+
+
+if __name__ == '__main__':
+    n_members = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    ncycles = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+    backend = sys.argv[3] if len(sys.argv) > 3 else 'numpy'
+
+    rng = np.random.default_rng(0)
+    truth = WurschCraigModel(seed=1, backend=backend)
+    ensemble = WurschCraigModel(seed=2, n_members=n_members, backend=backend)
+    letkf = LETKF(LOCALISATION, INFLATION)
+
+    # the network observes all the variables at the same points
+    points = np.arange(0, truth.N, OBS_EVERY)
+    names = np.repeat(list(OBS_ERRORS), points.size)
+    errors = np.repeat(list(OBS_ERRORS.values()), points.size)
+    points = np.tile(points, len(OBS_ERRORS))
+    nsteps = int(round(CYCLE / truth.dt))
+
+    start = time.time()
+    truth.advance(int(round(SPIN_UP / truth.dt)))
+    ensemble.advance(int(round(SPIN_UP / truth.dt)))
+
+    print('%8s  %21s  %21s  %21s' % ('', 'u rmse / spread', 'h rmse / spread', 'r rmse / spread'))
+    for cycle in range(ncycles):
+        truth.advance(nsteps)
+        ensemble.advance(nsteps)
+        background = [scores(ensemble, truth, name) for name in ('u', 'h', 'r')]
+
+        obs = Observations.synthetic(truth, names, points, errors, rng)
+        letkf.analyse(ensemble, obs)
+        analysis = [scores(ensemble, truth, name) for name in ('u', 'h', 'r')]
+
+        for label, s in (('f', background), ('a', analysis)):
+            print('%s %s  %10.3g %10.3g  %10.3g %10.3g  %10.3g %10.3g' % (
+                    seconds_to_time(truth.t), label, *[v for pair in s for v in pair]))
+
+    print('%d members, %d cycles: %.1f s' % (n_members, ncycles, time.time() - start))